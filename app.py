@@ -5,395 +5,1746 @@ Flask Webアプリ
 """
 
 from flask import Flask, request, send_file, render_template_string, jsonify
+import codecs
 import csv
 import io
 import zipfile
 from datetime import datetime, date
-from collections import defaultdict
+from collections import defaultdict, deque, OrderedDict, Counter
 import openpyxl
 from openpyxl.styles import Font, PatternFill, Alignment, Border, Side, numbers
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.utils.exceptions import IllegalCharacterError
+from openpyxl.packaging.custom import StringProperty
+from openpyxl.packaging.extended import ExtendedProperties
+from openpyxl.packaging.manifest import Manifest, Override
+from openpyxl.styles.stylesheet import write_stylesheet
+try:
+    # stream エンジン用（openpyxl の内部モジュール。無い版では stream を使わない）
+    from openpyxl.worksheet._writer import WorksheetWriter
+    from openpyxl.workbook._writer import WorkbookWriter
+except ImportError:
+    WorksheetWriter = WorkbookWriter = None
+from openpyxl.writer.excel import ExcelWriter
+from openpyxl.writer.theme import theme_xml
+from openpyxl.xml.constants import (ARC_APP, ARC_CORE, ARC_CUSTOM, ARC_ROOT_RELS, ARC_STYLE, ARC_THEME,
+                                    ARC_WORKBOOK, ARC_WORKBOOK_RELS, CPROPS_TYPE)
+from openpyxl.xml.functions import tostring
+from xml.sax.saxutils import escape as xml_escape
 import json
 import os
 import tempfile
+import shutil
+import threading
+import time
+import sqlite3
+from contextlib import closing
+from copy import copy
+import unicodedata
+import hashlib
+import re
+import zlib
+import heapq
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from operator import attrgetter
+from functools import lru_cache
+from itertools import chain, groupby, islice
+from array import array
+try:
+    import numpy as np      # あれば集計をベクトル演算で行う（無くても動く）
+except ImportError:
+    np = None
 
 app = Flask(__name__)
 
 # =====================================================
-# 摘要パターン辞書（科目自動付与）
+# 仕訳辞書（科目自動付与）
 # 実際のCSVデータ（1,204件）を分析して作成
+# 内容は rules.json に外出し（再デプロイなしで更新可能）
 # =====================================================
+RULES_PATH = os.environ.get(
+    'RULES_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json'))
+RULES_CHECK_INTERVAL = float(os.environ.get('RULES_CHECK_INTERVAL', 5))  # 秒
+
+# 辞書ファイルの必須項目と型
+RULE_TABLE_TYPES = {
+    'category_map':       dict,  # 科目 → 大カテゴリ
+    'other_patterns':     dict,  # 内部振替・手数料（最優先）
+    'outsource_patterns': dict,  # 外注費
+    'purchase_patterns':  dict,  # 仕入
+    'finance_patterns':   dict,  # 事業借入・長期未払金
+    'fee_patterns':       dict,  # 支払手数料
+    'fixed_patterns':     dict,  # 固定費各種
+    'misc_patterns':      dict,  # 租税公課・その他
+    'staff_names':        list,  # 人件費（スタッフ名）
+    'corporate_markers':  list,  # 出金フォールバック：法人表記は外注費扱い
+    'sales_keywords':     list,  # 売上収入キーワード
+    'sales_sub_patterns': list,  # 入金の補助科目 [[キーワード...], 補助科目]（上から順に判定）
+}
+
+def load_rule_tables(path=None):
+    """仕訳辞書ファイルを読み込んで (バージョン, テーブル辞書) を返す"""
+    with open(path or RULES_PATH, encoding='utf-8') as fp:
+        data = json.load(fp)
+
+    tables = {}
+    for key, typ in RULE_TABLE_TYPES.items():
+        if not isinstance(data.get(key), typ):
+            raise ValueError(f"仕訳辞書の {key} が見つからないか形式が不正です")
+        tables[key] = data[key]
+
+    # パターンの値は (科目, 補助科目) のタプルに揃える
+    for key in ('other_patterns', 'outsource_patterns', 'purchase_patterns', 'finance_patterns',
+                'fee_patterns', 'fixed_patterns', 'misc_patterns'):
+        tables[key] = {kw: tuple(v) for kw, v in tables[key].items()}
+    tables['sales_sub_patterns'] = [(list(kws), sub) for kws, sub in tables['sales_sub_patterns']]
+
+    return str(data.get('version', '')), tables
 
 # =====================================================
-# 大カテゴリ定義 ── 会社正式科目体系（2026年2月版）
+# 摘要の正規化（全角/半角・ダッシュ・空白の表記ゆれ吸収）
 # =====================================================
-CATEGORY_MAP = {
-    # 収入
-    "売上":           "🟢 売上",
-    # 仕入
-    "仕入":           "🔵 仕入",
-    # 外注
-    "外注費":         "🟡 外注費",
-    # 人件費
-    "人件費":         "🟠 人件費",
-    # 販管費各種
-    "交際費":         "🟣 交際費",
-    "旅費交通費":     "🟣 旅費交通費",
-    "車両費":         "🟣 車両費",
-    "地代家賃":       "🟣 地代家賃",
-    "光熱費":         "🟣 光熱費",
-    "消耗品":         "🟣 消耗品",
-    "通信費":         "🟣 通信費",
-    "支払手数料":     "🟣 支払手数料",
-    "福利厚生":       "🟣 福利厚生",
-    "保険料":         "🟣 保険料",
-    "租税公課":       "🟣 租税公課",
-    "雑費":           "🟣 雑費",
-    # 財務
-    "事業借入":       "🔴 事業借入",
-    "長期未払金":     "🔴 長期未払金",
-    # 内部
-    "口座振替":       "⚪ 振替",
-    "現金引出":       "⚪ 振替",
-    "受取利息":       "🟢 売上",
-}
+_DASH_CHARS = '-‐‑‒–—―−ー－ｰ﹣'
+_SMALL_KANA = 'ァィゥェォッャュョヮヵヶ'
+_LARGE_KANA = 'アイウエオツヤユヨワカケ'
+_CANON_TABLE = str.maketrans({
+    **{c: '-' for c in _DASH_CHARS},
+    **dict(zip(_SMALL_KANA, _LARGE_KANA)),  # 銀行摘要は小書き文字を使わない
+    ' ': None, '\t': None,
+})
+
+@lru_cache(maxsize=65536)
+def normalize_text(text):
+    """
+    照合用の正規形に変換する
+    NFKC（半角カナ→全角・全角英数→半角）後、ダッシュ類を '-' に統一し、空白を除去
+    """
+    return unicodedata.normalize('NFKC', text).translate(_CANON_TABLE)
 
 # =====================================================
-# 仕訳辞書 ── 会社正式科目体系（全件精査済み）
+# 摘要キーワード照合エンジン（Aho-Corasick）
 # =====================================================
+class KeywordAutomaton:
+    """複数キーワードを摘要1パスで検出するAho-Corasickオートマトン"""
 
-# ── 【内部振替・手数料】最優先 ──────────────────────────
-OTHER_PATTERNS = {
-    "振替 事業口座":            ("口座振替", "事業口座"),
-    "振替 個人口座":            ("口座振替", "個人口座"),
-    "カミデ　ケンタロウ":       ("口座振替", "資金移動"),  # 代表者口座間移動
-    "ATM":                      ("現金引出", ""),
-    "Mastercardデビット年会費": ("雑費",     "カード年会費"),
-    "普通預金 利息":            ("受取利息", ""),
-    "振込手数料":               ("支払手数料", "振込手数料"),
-}
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        goto, fail, out = [{}], [0], [()]
+        self._always = frozenset(i for i, kw in enumerate(self.keywords) if not kw)
 
-# ── 【仕入】 ──────────────────────────────────────────
-PURCHASE_PATTERNS = {
-    # 栄養補助・サプリメント
-    "フリ−マンニユ−トラグル−プ":      ("仕入", "栄養補助食品"),
-    "シゼンケンコウシヤ":              ("仕入", "健康食品"),
-    "ＢＩＯ　ＡＣＴＩＶＥＳ　ＪＡＰＡＮ": ("仕入", "サプリ・輸入"),
-    # 動物薬・医薬品
-    "ニホンゼンヤクコウギヨウ":         ("仕入", "動物薬"),
-    "ニホンゼンヤクコウギヨウカブシキ": ("仕入", "動物薬"),
-    # 飼料・農業資材
-    "エムピ−アグロ．カ":              ("仕入", "飼料・動物薬"),
-    "MHF)MPｱｸﾞﾛ":                     ("仕入", "飼料・動物薬"),
-    "MPｱｸﾞﾛ":                          ("仕入", "飼料・動物薬"),
-    "カ）ムラカミキユウシヤ":          ("仕入", "飼料"),
-    "ムラカミキユウシヤ":              ("仕入", "飼料"),
-    # ITシステム（仕入原価扱い）
-    "カ）シ−アイシ−フロンテイア":     ("仕入", "ITシステム"),
-    # その他仕入
-    "シグニ（カ":                      ("仕入", "仕入"),
-    "シグニ":                          ("仕入", "仕入"),
-    "ニホンガ−リツク":                ("仕入", "食材"),
-}
+        # トライ木構築
+        for idx, kw in enumerate(self.keywords):
+            if not kw:
+                continue
+            node = 0
+            for ch in kw:
+                nxt = goto[node].get(ch)
+                if nxt is None:
+                    nxt = len(goto)
+                    goto[node][ch] = nxt
+                    goto.append({})
+                    fail.append(0)
+                    out.append(())
+                node = nxt
+            out[node] = out[node] + (idx,)
+
+        # 失敗リンク（幅優先）
+        queue = deque(goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, nxt in goto[node].items():
+                queue.append(nxt)
+                f = fail[node]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0) if node else 0
+                out[nxt] = out[nxt] + out[fail[nxt]]
+
+        self._goto, self._fail, self._out = goto, fail, out
+        # 遷移表（失敗リンクを辿った結果をメモ化して1文字1回の辞書引きにする）
+        self._delta = [dict(g) for g in goto]
+
+    def _resolve(self, node, ch):
+        """失敗リンクを辿って遷移先を求め、遷移表に記録する"""
+        goto, fail = self._goto, self._fail
+        n = node
+        while n and ch not in goto[n]:
+            n = fail[n]
+        nxt = goto[n].get(ch, 0)
+        self._delta[node][ch] = nxt
+        return nxt
+
+    def find_all(self, text):
+        """text に含まれるキーワードの番号集合を返す"""
+        delta, out = self._delta, self._out
+        found = set(self._always)
+        node = 0
+        for ch in text:
+            nxt = delta[node].get(ch)
+            if nxt is None:
+                nxt = self._resolve(node, ch)
+            node = nxt
+            if out[node]:
+                found.update(out[node])
+        return found
 
-# ── 【外注費】 ────────────────────────────────────────
-OUTSOURCE_PATTERNS = {
-    # 個人委託
-    "カ）キタマ":                      ("外注費", "業務委託"),
-    "サダモト　ユウイチ":              ("外注費", "業務委託"),
-    "タグチ　カズオミ":                ("外注費", "業務委託"),
-    "トミタ　ジユン":                  ("外注費", "業務委託"),
-    "カ）マルサセンタ−":               ("外注費", "業務委託"),
-    "ド）カリテイ−":                  ("外注費", "業務委託"),
-    # 輸入・貿易
-    "ナ−ヴイツク　インタ−ナシヨナル": ("外注費", "輸入・貿易"),
-    "イ−ビ−エムトレ−デイング":       ("外注費", "輸入・貿易"),
-    # 馬医療
-    "カ）エクワインベツトグル−プ":     ("外注費", "馬医療"),
-    # 専門家
-    "ゼイ）スバルゴウドウカイケイ":    ("外注費", "税理士"),
-    "ザイ）リユウツウシステムカイハツ": ("外注費", "システム開発"),
-    "ザイ）セイブツカガクアンゼンケンキユウシヨ": ("外注費", "研究費"),
-    # コンサル
-    "クイ−ンビ−キヤピタル（カ":       ("外注費", "経営コンサル"),
-    # その他外注
-    "カ）アイレツクス":                ("外注費", "外注"),
-    "カツヤマネクステ−ジ":             ("外注費", "外注"),
-    "アナザ−レ−ン":                   ("外注費", "外注"),
-}
 
-# ── 【人件費（スタッフ名）】 ──────────────────────────
-STAFF_NAMES = [
-    "カミデ　サオリ",       # 家族スタッフ
-    "オオムラ　トシノリ",   # スタッフ
-    "コイズミ　ユカリ",     # スタッフ
-    "ギヨウトク　マリア",   # スタッフ
-    "キタハラ　ミユキ",     # スタッフ
-    "サカモト　ミカ",       # スタッフ
-    "タカハシ　ナオミ",     # スタッフ
-    "サカイ　ケイコ",       # スタッフ
-    "ハタケヤマ　ヨシカズ",  # スタッフ
-    "ヤスカワ　エミコ",     # スタッフ
-    "ナガクラ　ミスズ",     # スタッフ
-    "ヤガミ　アヤノブ",     # スタッフ
-    "サトウ　ユウナ",       # スタッフ
-    "サトウ　カヨコ",       # スタッフ
-    "ムトウ　アユミ",       # スタッフ
-    "ヨシキ　カツヒコ",     # スタッフ
-    "ナガタ　ユキヒロ",     # スタッフ
-    "オオイシ　ユウヤ",     # スタッフ
-    "ウエスギ　ユカリ",     # スタッフ
-    "フジタ　カナ",         # スタッフ
-    "タムラ　シンジ",       # スタッフ
-    "サクライ　ハルミチ",   # スタッフ
-    "ナガクラ　ミスズ",     # スタッフ
-    "カンザキ　アユミ",     # スタッフ（Amex経由も含む）
-    "オリベツト",           # スタッフ（カンザキ　アユミ）
-]
+# =====================================================
+# 類似摘要インデックス（キーワード不一致時のフォールバック）
+# =====================================================
+SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', 0.6))
+SIMILARITY_BUDGET_MS = float(os.environ.get('SIMILARITY_BUDGET_MS', 2))  # 1行あたりの上限
 
-# ── 【財務：事業借入・長期未払金】 ──────────────────────
-FINANCE_PATTERNS = {
-    # 事業借入（政策金融公庫）
-    "ｶ)ﾆﾂﾎﾟﾝｾｲｻｸｷﾝﾕｳｺｳｺ":              ("事業借入", "政策金融公庫"),
-    "カ）　ニツポンセイサクキンユウコウコ": ("事業借入", "政策金融公庫"),
-    "ニツポンセイサクキンユウコウコ":       ("事業借入", "政策金融公庫"),
-    # 長期未払金（クレジットカード・立替）
-    "マネ−フオワ−ドケツサイ":             ("長期未払金", "クレジット"),
-    "APｱﾌﾟﾗｽ":                            ("長期未払金", "クレジット"),
-    "アメリカンエキスプレスインタ−ナシヨナルインコ−ポレイテツド": ("長期未払金", "Amex"),
-    "アメリカンエキスプレスインタ−ナシヨナル": ("長期未払金", "Amex"),
-    "ミツイスミトモカ−ド":                 ("長期未払金", "クレジット"),
-}
+def _ngrams(text, n=3):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
 
-# ── 【支払手数料】 ────────────────────────────────────
-FEE_PATTERNS = {
-    "カ）ベイフラワ−":    ("支払手数料", "販売手数料"),  # 花販売手数料
-    "MHF)ﾔﾏﾄｳﾝﾕ":        ("支払手数料", "配送料"),
-    "ﾔﾏﾄｳﾝﾕ":             ("支払手数料", "配送料"),
-    "カ）シムネツト":      ("支払手数料", "通信・システム"),
-}
+class SimilarityIndex:
+    """
+    既知の支払先（辞書キーワード・判定できた摘要）の文字3-gram転置索引
+    類似度: キーワード … キーワードの3-gramのうち摘要に含まれる割合（ほぼ含まれていれば一致）
+            判定済み摘要 … Dice係数（摘要全体が似ていれば一致）
+    RuleIndex が持つのはキーワードだけの索引（変更しない）。判定できた摘要は fork() した索引に
+    1ファイル（または1バッチ）の間だけ学習させる（判定結果がほかのアップロードや処理順に左右されないように）
+    """
 
-# ── 【固定費各種】 ────────────────────────────────────
-FIXED_PATTERNS = {
-    "エアウオ−タ−ヒガシニホン": ("光熱費",   "ガス"),
-    "フクシマトヨタ":            ("車両費",   ""),
-    "ラクスル":                  ("消耗品",   "印刷・消耗品"),
-}
+    MIN_SHARED  = 3      # 共有3-gramがこれ未満なら候補にしない
+    MAX_LEARNED = 20000  # 学習する摘要の上限
+
+    def __init__(self, threshold=SIMILARITY_THRESHOLD, budget_ms=SIMILARITY_BUDGET_MS, base=None):
+        self.threshold = threshold
+        self.budget = budget_ms / 1000
+        self.base = base                     # fork 元（その登録分も候補にする）
+        self._offset = len(base._entries) if base else 0  # この索引のエントリ番号は fork 元の続きから
+        self._entries = []                   # (正規形テキスト, キーワード番号, 3-gram数, 学習分か)
+        self._postings = defaultdict(list)   # 3-gram → エントリ番号
+        self._known = set()
+        self._learned = 0
+        self.timeouts = 0                    # 時間切れで打ち切った検索の数（結果が時間に左右された）
+        self._lock = threading.Lock()
+
+    def fork(self):
+        """この索引の登録分を土台に、追加分だけを別に持つ索引（fork 元は変わらない）"""
+        return SimilarityIndex(self.threshold, self.budget * 1000, base=self)
+
+    def _is_known(self, text):
+        return text in self._known or (self.base is not None and self.base._is_known(text))
+
+    def add(self, text, rule_idx, learned=False):
+        """正規形テキストを rule_idx の判定結果として登録"""
+        grams = _ngrams(text)
+        if len(grams) < self.MIN_SHARED or self._is_known(text):
+            return
+        with self._lock:
+            if text in self._known or (learned and self._learned >= self.MAX_LEARNED):
+                return
+            self._known.add(text)
+            eid = self._offset + len(self._entries)
+            self._entries.append((text, rule_idx, len(grams), learned))
+            for g in grams:
+                self._postings[g].append(eid)
+            if learned:
+                self._learned += 1
+
+    def nearest(self, text, accept):
+        """
+        text に最も近いエントリのキーワード番号を返す
+        accept(キーワード番号) が偽のエントリは除外。閾値未満・時間切れは None（時間切れは timeouts に数える）
+        """
+        deadline = time.perf_counter() + self.budget
+        grams = _ngrams(text)
+        shared = Counter()
+        base = self.base
+        for g in grams:
+            if base is not None:
+                shared.update(base._postings.get(g, ()))
+            shared.update(self._postings.get(g, ()))
+            if time.perf_counter() > deadline:
+                self.timeouts += 1
+                return None
+
+        best, best_key = None, None
+        entries, offset = self._entries, self._offset
+        for eid, n in shared.items():
+            if n < self.MIN_SHARED:
+                continue
+            if time.perf_counter() > deadline:
+                self.timeouts += 1
+                return None
+            _, rule_idx, size, learned = entries[eid - offset] if eid >= offset else base._entries[eid]
+            score = 2 * n / (size + len(grams)) if learned else n / size
+            key = (score, n, -eid)  # 同点なら共有数が多い方、さらに先に登録された方
+            if score >= self.threshold and (best_key is None or key > best_key) and accept(rule_idx):
+                best, best_key = rule_idx, key
+        return best
+
+# 判定の決め手（キーワード番号以外）
+HIT_FALLBACK_OUT = -1  # STEP2末尾のフォールバック（人件費/スタッフ）
+HIT_FALLBACK_IN  = -2  # STEP3で補助科目なし（売上）
+HIT_NONE         = -3  # 入出金とも0でキーワードなし
+HIT_SIMILAR      = -4  # キーワードなし → 類似する既知の支払先から推定
+HIT_CORRECTION   = -5  # 手修正の上書き表に一致
+
+class RuleIndex:
+    """
+    仕訳辞書を優先順に並べてオートマトンへコンパイルしたもの
+    キーワード番号が小さいほど優先度が高い（STEP1 → STEP2 → STEP3）
+    一度作ったら変更しない（差し替えは get_rule_index が新しいインスタンスで行う）
+    """
+
+    def __init__(self, tables, version=''):
+        keywords, rules = [], []
+
+        def add(step, kw, result):
+            keywords.append(kw)
+            rules.append((step, result))
+
+        # STEP1: 方向問わず確定
+        for kw, result in tables['other_patterns'].items():
+            add(1, kw, result)
+        # STEP2: 出金（外注費 → 仕入 → 財務 → 手数料 → 固定費 → 租税公課 → 人件費 → 法人表記）
+        for key in ('outsource_patterns', 'purchase_patterns', 'finance_patterns',
+                    'fee_patterns', 'fixed_patterns', 'misc_patterns'):
+            for kw, result in tables[key].items():
+                add(2, kw, result)
+        for name in tables['staff_names']:
+            add(2, name, ("人件費", "スタッフ"))
+        for kw in tables['corporate_markers']:
+            add(2, kw, ("外注費", "法人委託"))
+        # STEP3: 入金の補助科目
+        for kws, sub in tables['sales_sub_patterns']:
+            for kw in kws:
+                add(3, kw, ("売上", sub))
+
+        keywords, rules = self._canonicalize(keywords, rules)
+
+        self.version = version
+        self.tables = tables
+        self.keywords = keywords
+        self.rules = rules
+        self.category_map = tables['category_map']
+        self.automaton = KeywordAutomaton(keywords)
+        self.similar = SimilarityIndex()
+        for idx, kw in enumerate(keywords):
+            self.similar.add(kw, idx)
+
+    @staticmethod
+    def _canonicalize(keywords, rules):
+        """
+        キーワードを正規形にし、判定結果が変わらない重複を除く
+        - 正規形が同じもの → 先頭（優先度の高い方）だけ残す
+        - 同じ判定結果の短いキーワードに包含されるもの（例: "MHF)ヤマトウンユ" ⊃ "ヤマトウンユ"）
+          → 間に別の判定結果のキーワードが挟まらない場合に限り除く
+        """
+        canon, canon_rules, seen = [], [], set()
+        for kw, rule in zip(keywords, rules):
+            ckw = normalize_text(kw)
+            if ckw in seen:
+                continue
+            seen.add(ckw)
+            canon.append(ckw)
+            canon_rules.append(rule)
+
+        def redundant(i):
+            for j, (kw, rule) in enumerate(zip(canon, canon_rules)):
+                if j == i or rule != canon_rules[i] or not kw or kw not in canon[i]:
+                    continue
+                lo, hi = sorted((i, j))
+                if j < i or all(r == rule for r in canon_rules[lo:hi]):
+                    return True
+            return False
+
+        keep = [i for i in range(len(canon)) if not redundant(i)]
+        return [canon[i] for i in keep], [canon_rules[i] for i in keep]
+
+    def classify(self, description, is_in, is_out, stats=None):
+        """
+        (科目, 補助科目, ヒット番号) を返す。該当なしは ("", "", HIT_NONE)
+        ヒット番号は決め手になったキーワード番号、またはフォールバック時の HIT_* 定数
+        辞書だけで決まる（類似推定はしない）ので、同じ摘要・入出金方向なら常に同じ結果
+        stats を渡すと正規化・照合・確定の各段階の処理時間を記録する
+        """
+        t0 = time.perf_counter_ns()
+        text = normalize_text(description)
+        t1 = time.perf_counter_ns()
+        found = self.automaton.find_all(text)
+        t2 = time.perf_counter_ns()
+        result = self._settle(found, is_in, is_out)
+        t3 = time.perf_counter_ns()
+        if stats is not None:
+            stats.add_timing('normalize', t1 - t0)
+            stats.add_timing('match', t2 - t1)
+            stats.add_timing('settle', t3 - t2)
+        return result
+
+    # 類似推定は STEP2/STEP3 のみ（振替・ATM等の STEP1 は明示キーワードでしか確定させない）
+    def learn(self, description, hit, similar):
+        """キーワードで判定できた摘要を similar（self.similar を fork した索引）の候補に加える"""
+        if hit >= 0 and self.rules[hit][0] != 1:
+            similar.add(normalize_text(description), hit, learned=True)
+
+    def classify_similar(self, description, is_in, is_out, similar, stats=None):
+        """キーワードなしの摘要に最も近い既知の支払先の (科目, 補助科目, HIT_SIMILAR)。無ければ None"""
+        t0 = time.perf_counter_ns()
+        rule_idx = similar.nearest(
+            normalize_text(description), lambda i: self.rules[i][0] != 1 and self._applies(i, is_in, is_out))
+        if stats is not None:
+            stats.add_timing('similar', time.perf_counter_ns() - t0)
+        if rule_idx is None:
+            return None
+        subject, sub = self.rules[rule_idx][1]
+        return (subject, sub, HIT_SIMILAR)
+
+    def _applies(self, idx, is_in, is_out):
+        step = self.rules[idx][0]
+        return step == 1 or (step == 2 and is_out) or (step == 3 and is_in and not is_out)
+
+    def _settle(self, found, is_in, is_out):
+        """検出したキーワードから優先順に科目を確定する"""
+        for idx in sorted(found):
+            if self._applies(idx, is_in, is_out):
+                subject, sub = self.rules[idx][1]
+                return (subject, sub, idx)
+
+        # フォールバック
+        if is_out:
+            return ("人件費", "スタッフ", HIT_FALLBACK_OUT)
+        if is_in:
+            return ("売上", "", HIT_FALLBACK_IN)
+        return ("", "", HIT_NONE)
+
+
+def compile_rule_index(path=None):
+    """仕訳辞書ファイルから RuleIndex を生成"""
+    version, tables = load_rule_tables(path)
+    return RuleIndex(tables, version)
+
+RULE_INDEX = compile_rule_index()
+_rules_mtime   = os.stat(RULES_PATH).st_mtime_ns
+_rules_checked = time.monotonic()
+_rules_lock    = threading.Lock()
+
+def get_rule_index():
+    """
+    現在の RuleIndex を返す
+    辞書ファイルの更新（mtime変化）を検知したら再コンパイルして丸ごと差し替える。
+    呼び出し側は受け取ったインスタンスを使い続ければ処理中に辞書が変わることはない
+    """
+    global RULE_INDEX, _rules_mtime, _rules_checked
+    now = time.monotonic()
+    if now - _rules_checked < RULES_CHECK_INTERVAL:
+        return RULE_INDEX
+
+    with _rules_lock:
+        if now - _rules_checked < RULES_CHECK_INTERVAL:
+            return RULE_INDEX
+        _rules_checked = now
+        try:
+            mtime = os.stat(RULES_PATH).st_mtime_ns
+        except OSError:
+            return RULE_INDEX
+        if mtime != _rules_mtime:
+            _rules_mtime = mtime
+            try:
+                RULE_INDEX = compile_rule_index()
+                print(f"📚 仕訳辞書を再読み込みしました（v{RULE_INDEX.version}）")
+            except (OSError, ValueError) as e:
+                print(f"⚠️ 仕訳辞書の再読み込みに失敗しました（v{RULE_INDEX.version} を継続使用）: {e}")
+    return RULE_INDEX
+
+# =====================================================
+# 仕訳判定キャッシュ（摘要 × 入出金方向）
+# =====================================================
+class ClassificationCache:
+    """
+    プロセス内で共有する上限付きLRUキャッシュ
+    キャッシュ内容は作成元の RuleIndex に紐づき、辞書が差し替わると自動で空になる
+    """
 
-# ── 【租税公課・その他】 ──────────────────────────────
-MISC_PATTERNS = {
-    "フクシマケンジユウイシカイ":           ("租税公課", "獣医師会"),
-    "ゼンコクコウエイケイバジユウイシキヨウカイ": ("租税公課", "競馬獣医師会"),
-    "ソウマキヨウタンカイ":                 ("租税公課", "業界団体"),
-    "ジヤパンケネルクラブ":                 ("租税公課", "JKC"),
-    "オダカシヨウコウカイ":                 ("租税公課", "商工会"),
-    "ジ−ワンサラブレツドクラブ":           ("租税公課", "馬主クラブ"),
-    "カワサキゴ−ゴ−ドツグクラブ":          ("租税公課", "犬クラブ"),
-    "ヤマナシシンキン　エヌビ−シ−シユツパンキヨク": ("雑費", "出版"),
+    def __init__(self, maxsize=50000):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._index = None
+        self._lock = threading.Lock()
+
+    def get(self, index, key):
+        with self._lock:
+            if index is not self._index:
+                self._data.clear()
+                self._index = index
+            result = self._data.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, index, key, result):
+        with self._lock:
+            if index is not self._index:
+                return
+            self._data[key] = result
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'size': len(self._data), 'maxsize': self.maxsize}
+
+CLASSIFY_CACHE = ClassificationCache(int(os.environ.get('CLASSIFY_CACHE_SIZE', 50000)))
+
+def reload_rules():
+    """仕訳辞書ファイルを即時に読み直す。インデックスを再構築しキャッシュを破棄する"""
+    global RULE_INDEX, _rules_mtime, _rules_checked
+    with _rules_lock:
+        _rules_mtime   = os.stat(RULES_PATH).st_mtime_ns
+        _rules_checked = time.monotonic()
+        RULE_INDEX = compile_rule_index()
+        CLASSIFY_CACHE.clear()
+    return RULE_INDEX
+
+# =====================================================
+# 仕訳ルールのヒット集計（不要ルール・フォールバックの洗い出し用）
+# =====================================================
+STEP_LABELS = {
+    1: 'STEP1', 2: 'STEP2', 3: 'STEP3',
+    HIT_FALLBACK_OUT: 'STEP2フォールバック',
+    HIT_FALLBACK_IN:  'STEP3フォールバック',
+    HIT_NONE:         '判定なし',
+    HIT_SIMILAR:      '類似摘要から推定',
+    HIT_CORRECTION:   '手修正（上書き表）',
 }
 
-# ── 売上収入キーワード ─────────────────────────────────
-SALES_KEYWORDS = [
-    "チヤンピオンズフア−ム",
-    "マウンテンビユ−ステ−ブル",
-    "オイワケフア−ム",
-    "ナストレ−ニングフア−ム",
-    "アキバステ−ブル",
-    "リクル−ト　ペイメント",
-    "リクルート",
-    "アマゾンジヤパン",
-    "イ−ジ−　ラボ",
-]
+class RuleStats:
+    """キーワード別ヒット数・ステップ別件数・段階別処理時間・フォールバック摘要の集計"""
+
+    FALLBACK_LIMIT = 10000  # 記録するフォールバック摘要の種類数の上限
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.rows = 0
+            self.rule_hits = Counter()              # (STEP, キーワード, 科目, 補助科目) → 件数
+            self.step_hits = Counter()              # STEP_LABELS → 件数
+            self.fallback  = {'out': Counter(), 'in': Counter(), 'similar': Counter()}  # 摘要 → 件数
+            self.timing    = defaultdict(lambda: [0, 0])          # 段階 → [回数, ns]
+
+    def __getstate__(self):
+        # 子プロセスから親へ渡すとき用（ロックと defaultdict は送らない）
+        with self._lock:
+            return {'rows': self.rows, 'rule_hits': self.rule_hits, 'step_hits': self.step_hits,
+                    'fallback': self.fallback, 'timing': dict(self.timing)}
+
+    def __setstate__(self, state):
+        self.__init__()
+        self.rows      = state['rows']
+        self.rule_hits = state['rule_hits']
+        self.step_hits = state['step_hits']
+        self.fallback  = state['fallback']
+        self.timing.update(state['timing'])
+
+    def add_timing(self, phase, ns):
+        with self._lock:
+            t = self.timing[phase]
+            t[0] += 1
+            t[1] += ns
+
+    def record(self, index, hit, description, count=1):
+        """判定結果 count 行分を記録"""
+        with self._lock:
+            self.rows += count
+            if hit >= 0:
+                step, (subject, sub) = index.rules[hit]
+                self.rule_hits[(step, index.keywords[hit], subject, sub)] += count
+                self.step_hits[STEP_LABELS[step]] += count
+                return
+            self.step_hits[STEP_LABELS[hit]] += count
+            bucket = {HIT_FALLBACK_OUT: self.fallback['out'],
+                      HIT_FALLBACK_IN:  self.fallback['in'],
+                      HIT_SIMILAR:      self.fallback['similar']}.get(hit)
+            if bucket is not None and (description in bucket or len(bucket) < self.FALLBACK_LIMIT):
+                bucket[description] += count
+
+    def merge(self, other):
+        with other._lock:
+            rows, rule_hits, step_hits = other.rows, Counter(other.rule_hits), Counter(other.step_hits)
+            fallback = {k: Counter(v) for k, v in other.fallback.items()}
+            timing = {k: list(v) for k, v in other.timing.items()}
+        with self._lock:
+            self.rows += rows
+            self.rule_hits.update(rule_hits)
+            self.step_hits.update(step_hits)
+            for k, counter in fallback.items():
+                bucket = self.fallback[k]
+                for desc, n in counter.items():
+                    if desc in bucket or len(bucket) < self.FALLBACK_LIMIT:
+                        bucket[desc] += n
+            for phase, (calls, ns) in timing.items():
+                t = self.timing[phase]
+                t[0] += calls
+                t[1] += ns
+
+    def report(self, index=None, top=100):
+        """JSON化できる集計結果。index のキーワードのうちヒット0件のものを dead_rules に挙げる"""
+        index = index or get_rule_index()
+        with self._lock:
+            hits = Counter(self.rule_hits)
+            for kw, (step, (subject, sub)) in zip(index.keywords, index.rules):
+                hits.setdefault((step, kw, subject, sub), 0)
+            rules = [{'step': step, 'keyword': kw, 'subject': subject, 'sub_subject': sub, 'hits': n}
+                     for (step, kw, subject, sub), n in sorted(hits.items(), key=lambda x: (-x[1], x[0][0]))]
+            return {
+                'rule_version': index.version,
+                'rows': self.rows,
+                'steps': dict(self.step_hits),
+                'timing': {phase: {'calls': calls,
+                                   'total_ms': round(ns / 1e6, 3),
+                                   'avg_us': round(ns / calls / 1e3, 2) if calls else 0}
+                           for phase, (calls, ns) in self.timing.items()},
+                'rules': rules,
+                'dead_rules': [r['keyword'] for r in rules if not r['hits']],
+                'fallback': {k: [{'description': d, 'count': n} for d, n in v.most_common(top)]
+                             for k, v in self.fallback.items()},
+            }
+
+CLASSIFY_STATS = RuleStats()  # プロセス起動後の累計
+
+# =====================================================
+# 手修正の上書き表（経理担当の修正を翌月以降も自動適用）
+# =====================================================
+CORRECTIONS_DB = os.environ.get(
+    'CORRECTIONS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'corrections.sqlite3'))
+
+DIRECTION_ALIASES = {'': '', 'in': 'in', 'out': 'out', '入金': 'in', '出金': 'out'}
+
+class CorrectionStore:
+    """
+    摘要の完全一致（＋任意で入出金方向）→ (科目, 補助科目) の上書き表
+    SQLiteに永続化し、判定時はメモリ上の辞書だけを引く
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._index = {}  # (摘要, 'in'/'out'/'') → (科目, 補助科目)
+        self._mtime = None
+        self._revision = None  # (ハッシュを取った索引, ハッシュ)
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS corrections ("
+                " description TEXT NOT NULL,"
+                " direction   TEXT NOT NULL DEFAULT '',"
+                " subject     TEXT NOT NULL,"
+                " sub_subject TEXT NOT NULL DEFAULT '',"
+                " updated_at  TEXT NOT NULL,"
+                " PRIMARY KEY (description, direction))")
+        self.reload()
+
+    def refresh(self):
+        """他プロセスがSQLiteを更新していたら読み直す（解析用の子プロセス向け）"""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return
+        if mtime != self._mtime:
+            self.reload()
+
+    def reload(self):
+        """SQLiteから索引を作り直す"""
+        try:
+            self._mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            self._mtime = None
+        with closing(sqlite3.connect(self.path)) as conn:
+            rows = conn.execute(
+                "SELECT description, direction, subject, sub_subject FROM corrections").fetchall()
+        index = {(desc, direction): (subject, sub) for desc, direction, subject, sub in rows}
+        with self._lock:
+            self._index = index
+
+    def lookup(self, description, is_in, is_out):
+        """方向指定の上書きを優先し、なければ方向なしの上書きを返す。該当なしは None"""
+        index = self._index
+        if not index:
+            return None
+        direction = 'out' if is_out else 'in' if is_in else ''
+        return index.get((description, direction)) or index.get((description, ''))
+
+    def bulk_load(self, rows):
+        """
+        上書きをまとめて登録（同じ摘要・方向は置き換え）
+        rows: {'description', 'subject', 'sub_subject'(任意), 'direction'(任意: in/out/入金/出金)} の並び
+        戻り値: 登録件数
+        """
+        now = datetime.now().isoformat(timespec='seconds')
+        params = []
+        for r in rows:
+            if not isinstance(r, dict):
+                raise ValueError(f"上書きの形式が不正です: {r}")
+            desc = (r.get('description') or '').strip()
+            subject = (r.get('subject') or '').strip()
+            direction = DIRECTION_ALIASES.get((r.get('direction') or '').strip())
+            if not desc or not subject or direction is None:
+                raise ValueError(f"上書きの形式が不正です: {r}")
+            params.append((desc, direction, subject, (r.get('sub_subject') or '').strip(), now))
+
+        with self._lock:
+            with closing(sqlite3.connect(self.path)) as conn, conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO corrections"
+                    " (description, direction, subject, sub_subject, updated_at) VALUES (?, ?, ?, ?, ?)",
+                    params)
+            index = dict(self._index)
+            index.update({(desc, direction): (subject, sub) for desc, direction, subject, sub, _ in params})
+            self._index = index
+        return len(params)
+
+    def delete(self, description, direction=''):
+        with self._lock:
+            with closing(sqlite3.connect(self.path)) as conn, conn:
+                conn.execute("DELETE FROM corrections WHERE description = ? AND direction = ?",
+                             (description, direction))
+            index = dict(self._index)
+            index.pop((description, direction), None)
+            self._index = index
+
+    def revision(self):
+        """上書き表の中身のハッシュ（変換結果のキャッシュのキーに使う。索引は変更のたびに作り直すので同一性で判定）"""
+        index = self._index
+        if self._revision is None or self._revision[0] is not index:
+            digest = hashlib.sha1(repr(sorted(index.items())).encode('utf-8')).hexdigest()[:16]
+            self._revision = (index, digest)
+        return self._revision[1]
+
+    def all(self):
+        return [{'description': desc, 'direction': direction, 'subject': subject, 'sub_subject': sub}
+                for (desc, direction), (subject, sub) in sorted(self._index.items())]
+
+CORRECTIONS = CorrectionStore(CORRECTIONS_DB)
+
+def _classify(index, description, is_in, is_out, stats=None):
+    """
+    上書き表 → キャッシュ → 辞書判定の順で ((科目, 補助科目, 大カテゴリ, G列ラベル), ヒット番号) を求める
+    キャッシュするのは辞書だけで決まる結果（類似推定は classify_batch がバッチごとに行う）
+    """
+    corrected = CORRECTIONS.lookup(description, is_in, is_out)
+    if corrected is not None:
+        return (_labels(index, *corrected), HIT_CORRECTION)
+
+    key = (description, is_in, is_out)
+    cached = CLASSIFY_CACHE.get(index, key)
+    if cached is not None:
+        return cached
+
+    subject, sub, hit = index.classify(description, is_in, is_out, stats)
+    entry = (_labels(index, subject, sub), hit)
+    CLASSIFY_CACHE.put(index, key, entry)
+    return entry
+
+def _labels(index, subject, sub):
+    """大カテゴリ・G列ラベルを付けて (科目, 補助科目, 大カテゴリ, G列ラベル) にする"""
+    category  = index.category_map.get(subject, "⚪ その他")
+    mid_label = sub if sub else subject
+    g_label   = f"{category}  ›  {mid_label}" if subject else ""
+    return (subject, sub, category, g_label)
 
 def guess_subject(description, amount_in=0, amount_out=0):
     """
     会社正式科目体系に基づく仕訳判定（方向優先ロジック）
     戻り値: (科目, 補助科目, 大カテゴリ, G列ラベル)
     """
-    if not description:
-        return ("", "", "", "")
+    return classify_batch([description], [amount_in], [amount_out])[0]
 
-    subject, sub = "", ""
-    is_out = amount_out > 0
-    is_in  = amount_in  > 0
+def classify_batch(descriptions, amounts_in, amounts_out, index=None, stats=None, similar=None):
+    """
+    複数行をまとめて仕訳判定する
+    同じ（摘要, 入出金方向）は1回だけ判定し、結果を全行に配る
+    キーワードで決まらなかった摘要は、辞書キーワードとこのバッチ（similar を渡したときはそれまでに学習した分も）で
+    判定できた摘要から最も近いものを探す。全行のキーワード判定を済ませてから探すので、行の順番によらない
+    stats（RuleStats）を渡すとこのバッチ分のヒット集計も記録する
+    similar: 学習先の索引（index.similar.fork()。1ファイル分を通して使う）。省略時はこのバッチだけで学習する
+    戻り値: guess_subject と同じタプルのリスト（入力順）
+    """
+    index = index or get_rule_index()  # バッチ全体で同じ辞書を使う
+    if similar is None:
+        similar = index.similar.fork()
+    keys = [(desc, a_in > 0, a_out > 0)
+            for desc, a_in, a_out in zip(descriptions, amounts_in, amounts_out)]
+    counts = Counter(keys)
+
+    local = RuleStats()
+    results, hits = {}, {}
+    for key in counts:
+        desc, is_in, is_out = key
+        if not desc:
+            results[key] = ("", "", "", "")
+            continue
+        results[key], hits[key] = _classify(index, desc, is_in, is_out, local)
+        index.learn(desc, hits[key], similar)
 
-    # ── STEP1: 方向問わず確定するもの（最優先）──
-    for kw, result in OTHER_PATTERNS.items():
-        if kw in description:
-            subject, sub = result
-            break
+    for key, hit in hits.items():
+        if hit in (HIT_FALLBACK_OUT, HIT_FALLBACK_IN):
+            found = index.classify_similar(*key, similar, local)
+            if found is not None:
+                results[key], hits[key] = _labels(index, *found[:2]), HIT_SIMILAR
+        local.record(index, hits[key], key[0], counts[key])
 
-    # ── STEP2: 出金の科目判定 ──
-    if not subject and is_out:
+    CLASSIFY_STATS.merge(local)
+    if stats is not None:
+        stats.merge(local)
+    return [results[key] for key in keys]
 
-        # 外注費
-        for kw, result in OUTSOURCE_PATTERNS.items():
-            if kw in description:
-                subject, sub = result
-                break
+# =====================================================
+# 取込済み明細の指紋（重なった期間の再アップロードで既存行を読み飛ばす）
+# =====================================================
+FINGERPRINTS_DB = os.environ.get(
+    'FINGERPRINTS_DB', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fingerprints.sqlite3'))
 
-        # 仕入
-        if not subject:
-            for kw, result in PURCHASE_PATTERNS.items():
-                if kw in description:
-                    subject, sub = result
-                    break
+def row_fingerprint(date, description, amount_in, amount_out, balance, occurrence=0):
+    """
+    明細1行の指紋（日付・摘要・金額・残高の64bitハッシュ）
+    occurrence: 同じファイル内で全く同じ行が何回目か（同じ行が2件ある正当な明細を1件にまとめないため）
+    """
+    key = f"{date:%Y%m%d}\x1f{description}\x1f{amount_in}\x1f{amount_out}\x1f{balance}\x1f{occurrence}"
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big', signed=True)
 
-        # 財務（事業借入・長期未払金）
-        if not subject:
-            for kw, result in FINANCE_PATTERNS.items():
-                if kw in description:
-                    subject, sub = result
-                    break
+class FingerprintStore:
+    """
+    取込済み明細の指紋表
+    SQLiteに永続化し、照合はアップロードした行の指紋だけを主キーでまとめて引く（表全体はメモリに読まない）
+    """
 
-        # 支払手数料
-        if not subject:
-            for kw, result in FEE_PATTERNS.items():
-                if kw in description:
-                    subject, sub = result
-                    break
+    LOOKUP_BATCH = 500   # 1回の問い合わせの IN に並べる指紋の数（SQLite の変数の上限 999 より少なく）
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        with closing(sqlite3.connect(self.path)) as conn, conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS fingerprints ("
+                " fingerprint INTEGER PRIMARY KEY,"
+                " month       INTEGER NOT NULL,"   # 年*12 + 月-1
+                " added_at    TEXT NOT NULL)")
+
+    def lookup(self, fingerprints):
+        """fingerprints のうち取込済みのものの set"""
+        found = set()
+        with closing(sqlite3.connect(self.path)) as conn:
+            for i in range(0, len(fingerprints), self.LOOKUP_BATCH):
+                chunk = fingerprints[i:i + self.LOOKUP_BATCH]
+                found.update(fp for (fp,) in conn.execute(
+                    f"SELECT fingerprint FROM fingerprints WHERE fingerprint IN ({','.join('?' * len(chunk))})",
+                    chunk))
+        return found
+
+    def add(self, rows):
+        """(指紋, 月番号) を取込済みにする。追加した件数を返す"""
+        rows = list(rows)
+        if not rows:
+            return 0
+        now = datetime.now().isoformat(timespec='seconds')
+        with self._lock:
+            with closing(sqlite3.connect(self.path)) as conn, conn:
+                before = conn.total_changes
+                conn.executemany("INSERT OR IGNORE INTO fingerprints VALUES (?, ?, ?)",
+                                 ((fp, month, now) for fp, month in rows))
+                added = conn.total_changes - before
+        return added
+
+    def clear(self, since=None):
+        """指紋を消す（since=(年, 月) ならその月以降だけ）。消した件数を返す"""
+        with self._lock:
+            with closing(sqlite3.connect(self.path)) as conn, conn:
+                if since is None:
+                    n = conn.execute("DELETE FROM fingerprints").rowcount
+                else:
+                    n = conn.execute("DELETE FROM fingerprints WHERE month >= ?",
+                                     (since[0] * 12 + since[1] - 1,)).rowcount
+        return n
+
+    def info(self):
+        """月別の取込済み件数"""
+        with closing(sqlite3.connect(self.path)) as conn:
+            rows = conn.execute(
+                "SELECT month, COUNT(*) FROM fingerprints GROUP BY month ORDER BY month").fetchall()
+        return {
+            'rows': sum(n for _, n in rows),
+            'months': [{'month': f"{m // 12}-{m % 12 + 1:02d}", 'rows': n} for m, n in rows],
+        }
+
+FINGERPRINTS = FingerprintStore(FINGERPRINTS_DB)
 
-        # 固定費各種
-        if not subject:
-            for kw, result in FIXED_PATTERNS.items():
-                if kw in description:
-                    subject, sub = result
-                    break
+# =====================================================
+# 明細レコード（1取引 = Transaction）
+# =====================================================
+# 科目ラベル (科目, 補助科目, カテゴリ, G列表示) の共有表（同じ組は1つだけ持つ）
+_LABELS = [('', '', '', '')]
+_LABEL_IDS = {_LABELS[0]: 0}
+_labels_lock = threading.Lock()
+
+def intern_label(label):
+    """科目ラベルのタプルを共有表の番号に変換"""
+    label_id = _LABEL_IDS.get(label)
+    if label_id is None:
+        with _labels_lock:
+            label_id = _LABEL_IDS.get(label)
+            if label_id is None:
+                label_id = len(_LABELS)
+                _LABELS.append(label)
+                _LABEL_IDS[label] = label_id
+    return label_id
+
+class Transaction:
+    """
+    明細1行（日付・摘要・金額・残高と科目ラベル番号だけを持つ）
+    year/month/day は date から、科目・カテゴリ・G列は共有表から都度取り出す
+    従来の dict と同じく rec['amount_in'] / rec.get('subject', '') でも読める
+    """
 
-        # 租税公課・その他
-        if not subject:
-            for kw, result in MISC_PATTERNS.items():
-                if kw in description:
-                    subject, sub = result
-                    break
+    __slots__ = ('date', 'description', 'amount_in', 'amount_out', 'balance', 'label_id')
 
-        # 人件費（スタッフ名）
-        if not subject:
-            for name in STAFF_NAMES:
-                if name in description:
-                    subject, sub = "人件費", "スタッフ"
-                    break
+    FIELDS = ('date', 'year', 'month', 'day', 'description', 'amount_in', 'amount_out',
+              'balance', 'subject', 'sub_subject', 'category', 'g_label')
 
-        # フォールバック
-        if not subject:
-            if "カ）" in description or "（カ" in description or "ゼイ）" in description or "ザイ）" in description:
-                subject, sub = "外注費", "法人委託"
-            else:
-                subject, sub = "人件費", "スタッフ"
-
-    # ── STEP3: 入金の科目判定 ──
-    if not subject and is_in:
-        subject, sub = "売上", ""
-        # 補助科目で入金元を分類
-        if any(kw in description for kw in ["ステ−ブル","フア−ム","チヤンピオンズ","マウンテン","アキバ","オイワケ","ナストレ−ニング"]):
-            sub = "馬主・育成"
-        elif any(kw in description for kw in ["リクル−ト","ペイメント","ＡＩＲペイ","デイ−ジ−フイナンシヤル"]):
-            sub = "決済代行"
-        elif "アマゾン" in description:
-            sub = "Amazon"
-        elif "ラボ" in description or "イ−ジ−　ラボ" in description:
-            sub = "検査収入"
-        elif "ベイフラワ" in description:
-            sub = "花・装飾（売上）"
-        elif "ＰＡＹＰＡＬ" in description:
-            sub = "PayPal"
-
-    # 大カテゴリ・G列ラベル生成
-    category  = CATEGORY_MAP.get(subject, "⚪ その他")
-    mid_label = sub if sub else subject
-    g_label   = f"{category}  ›  {mid_label}" if subject else ""
+    def __init__(self, date, description, amount_in=0, amount_out=0, balance=0, label_id=0):
+        self.date        = date
+        self.description = description
+        self.amount_in   = amount_in
+        self.amount_out  = amount_out
+        self.balance     = balance
+        self.label_id    = label_id
 
-    return (subject, sub, category, g_label)
+    year  = property(lambda self: self.date.year)
+    month = property(lambda self: self.date.month)
+    day   = property(lambda self: self.date.day)
+
+    subject     = property(lambda self: _LABELS[self.label_id][0])
+    sub_subject = property(lambda self: _LABELS[self.label_id][1])
+    category    = property(lambda self: _LABELS[self.label_id][2])
+    g_label     = property(lambda self: _LABELS[self.label_id][3])
+
+    @property
+    def label(self):
+        return _LABELS[self.label_id]
+
+    @label.setter
+    def label(self, label):
+        self.label_id = intern_label(tuple(label))
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in self.FIELDS else default
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.FIELDS}
+
+    def __eq__(self, other):
+        if not isinstance(other, Transaction):
+            return NotImplemented
+        return (self.date, self.description, self.amount_in, self.amount_out, self.balance, self.label) == \
+               (other.date, other.description, other.amount_in, other.amount_out, other.balance, other.label)
+
+    __hash__ = None
+
+    def __reduce__(self):
+        # ラベル番号はプロセスごとに違うので、タプルのまま渡す
+        return (_restore_transaction,
+                (self.date, self.description, self.amount_in, self.amount_out, self.balance, self.label))
+
+    def __repr__(self):
+        return (f"Transaction({self.date:%Y-%m-%d}, {self.description!r}, in={self.amount_in}, "
+                f"out={self.amount_out}, bal={self.balance}, subject={self.subject!r})")
+
+def _restore_transaction(date, description, amount_in, amount_out, balance, label):
+    return Transaction(date, description, amount_in, amount_out, balance, intern_label(label))
+
+# 列指向の明細表（月別・科目別の集計用）
+NUMPY_MIN_ROWS = 5000   # これ未満の行数では numpy を使わない（変換の手間の方が大きい）
+
+def _group_totals(codes, ngroups, columns):
+    """
+    グループ番号 codes（0..ngroups-1）ごとに各列の合計・件数・最初と最後の行番号を求める
+    戻り値: (各列の合計リストのリスト, 件数リスト, 最初の行リスト, 最後の行リスト)（該当なしの行番号は -1）
+    """
+    n = len(codes)
+    if np is not None and n >= NUMPY_MIN_ROWS:
+        c = np.frombuffer(codes, dtype=np.int64)
+        sums = []
+        for col in columns:
+            s = np.zeros(ngroups, dtype=np.int64)
+            np.add.at(s, c, np.frombuffer(col, dtype=np.int64))
+            sums.append(s.tolist())
+        counts = np.bincount(c, minlength=ngroups).tolist()
+        first = np.full(ngroups, -1, dtype=np.int64)
+        last  = np.full(ngroups, -1, dtype=np.int64)
+        keys, idx = np.unique(c, return_index=True)
+        first[keys] = idx
+        keys, idx = np.unique(c[::-1], return_index=True)
+        last[keys] = n - 1 - idx
+        return sums, counts, first.tolist(), last.tolist()
+
+    sums = []
+    for col in columns:
+        s = [0] * ngroups
+        for g, v in zip(codes, col):
+            s[g] += v
+        sums.append(s)
+    counts = [0] * ngroups
+    for g, count in Counter(codes).items():
+        counts[g] = count
+    first = [-1] * ngroups
+    last  = [-1] * ngroups
+    for g, i in dict(zip(reversed(codes), range(n - 1, -1, -1))).items():
+        first[g] = i
+    for g, i in dict(zip(codes, range(n))).items():
+        last[g] = i
+    return sums, counts, first, last
+
+class TransactionTable:
+    """
+    明細（Transaction のリスト、日付順）を列ごとの配列に持ち替えた表
+    (年月 × 科目ラベル) ごとの合計・件数を1回の配列演算で求め、月別・科目別・カテゴリ別の集計はそこから足し上げる
+    （numpy があれば numpy で）
+    records: 元の Transaction のリスト（月別シートなど行単位の出力用）
+    """
+
+    def __init__(self, records):
+        self.records     = records
+        self.month_codes = array('q', [r.date.year * 12 + r.date.month - 1 for r in records])
+        self.amount_in   = array('q', [r.amount_in for r in records])
+        self.amount_out  = array('q', [r.amount_out for r in records])
+        self.balance     = array('q', [r.balance for r in records])
+        self.label_ids   = array('q', [r.label_id for r in records])
+        self._cube   = None
+        self._months = None
+        self._labels = None
+
+    def __len__(self):
+        return len(self.records)
+
+    @property
+    def total_in(self):
+        return sum(self.amount_in)
+
+    @property
+    def total_out(self):
+        return sum(self.amount_out)
+
+    def cube(self):
+        """
+        (年, 月) × 科目ラベルの集計
+        [{'ym': (年, 月), 'label': (科目, 補助科目, カテゴリ, G列表示), 'in', 'out', 'count', 'first', 'last'}]
+        年月順、同じ月の中は最初に現れた順。first/last はその組の最初と最後の行番号
+        """
+        if self._cube is None:
+            self._cube = []
+            if self.records:
+                base = min(self.month_codes)
+                # ラベル番号は全プロセス共通の通し番号なので、この表に出てくるものだけに詰め直す
+                label_codes = {label_id: i for i, label_id in enumerate(dict.fromkeys(self.label_ids))}
+                nlabels = len(label_codes)
+                codes = array('q', [(m - base) * nlabels + label_codes[label_id]
+                                    for m, label_id in zip(self.month_codes, self.label_ids)])
+                (ins, outs), counts, first, last = _group_totals(
+                    codes, (max(self.month_codes) - base + 1) * nlabels, (self.amount_in, self.amount_out))
+                label_ids = list(label_codes)
+                cells = []
+                for g, count in enumerate(counts):
+                    if count:
+                        month_index, label_code = divmod(g, nlabels)
+                        year, month0 = divmod(base + month_index, 12)
+                        cells.append({
+                            'ym': (year, month0 + 1), 'label': _LABELS[label_ids[label_code]],
+                            'in': ins[g], 'out': outs[g], 'count': count, 'first': first[g], 'last': last[g],
+                        })
+                cells.sort(key=lambda c: (c['ym'], c['first']))
+                self._cube = cells
+        return self._cube
+
+    def month_totals(self):
+        """{(年, 月): {'in', 'out', 'count', 'balance'（月末残高）}}（年月順・明細のある月だけ）"""
+        if self._months is None:
+            self._months = {}
+            for c in self.cube():
+                d = self._months.setdefault(c['ym'], {'in': 0, 'out': 0, 'count': 0, 'balance': 0, '_last': -1})
+                d['in']    += c['in']
+                d['out']   += c['out']
+                d['count'] += c['count']
+                d['_last'] = max(d['_last'], c['last'])
+            for d in self._months.values():
+                d['balance'] = self.balance[d.pop('_last')]
+        return self._months
+
+    def month(self, year, month):
+        """指定月の集計（明細が無ければ None）"""
+        return self.month_totals().get((year, month))
+
+    def label_totals(self):
+        """科目ラベル (科目, 補助科目, カテゴリ, G列表示) ごとの集計（最初に現れた順）"""
+        if self._labels is None:
+            data = {}
+            for c in self.cube():
+                d = data.setdefault(c['label'], {'label': c['label'], 'in': 0, 'out': 0, 'count': 0,
+                                                 'first': c['first'], 'last': -1})
+                d['in']    += c['in']
+                d['out']   += c['out']
+                d['count'] += c['count']
+                d['first'] = min(d['first'], c['first'])
+                d['last']  = max(d['last'], c['last'])
+            self._labels = sorted(data.values(), key=lambda d: d['first'])
+        return self._labels
+
+    def subject_totals(self):
+        """
+        科目ごとの集計 {科目: {'in', 'out', 'count', 'category', 'sub_sample'}}（最初に現れた順）
+        category は最後に現れた明細のカテゴリ、sub_sample は最初に現れた補助科目
+        """
+        data = {}
+        for t in self.label_totals():
+            subject, sub, category, _ = t['label']
+            d = data.setdefault(subject, {'in': 0, 'out': 0, 'count': 0, 'category': '',
+                                          'sub_sample': '', '_last': -1, '_sub_first': None})
+            d['in']    += t['in']
+            d['out']   += t['out']
+            d['count'] += t['count']
+            if t['last'] > d['_last']:
+                d['_last'], d['category'] = t['last'], category
+            if sub and (d['_sub_first'] is None or t['first'] < d['_sub_first']):
+                d['_sub_first'], d['sub_sample'] = t['first'], sub
+        for d in data.values():
+            del d['_last'], d['_sub_first']
+        return data
+
+    def category_totals(self):
+        """カテゴリごとの集計 {カテゴリ: {'in', 'out', 'count'}}"""
+        data = {}
+        for t in self.label_totals():
+            d = data.setdefault(t['label'][2], {'in': 0, 'out': 0, 'count': 0})
+            d['in']    += t['in']
+            d['out']   += t['out']
+            d['count'] += t['count']
+        return data
 
 # =====================================================
 # CSV解析
 # =====================================================
-def parse_bank_csv(file_bytes):
-    """銀行明細CSVを解析してデータリストを返す"""
-    # エンコーディング自動検出
-    for enc in ['shift_jis', 'cp932', 'utf-8-sig', 'utf-8']:
+ENCODING_SAMPLE_SIZE = 64 * 1024  # エンコーディング判定に使う先頭バイト数
+
+# cp932 でだけ別の文字になるものを shift_jis と同じ文字に揃える（辞書・上書き表の表記に合わせる）
+_CP932_TO_SJIS = str.maketrans('～∥－￠￡￢', '〜‖−¢£¬')
+
+def detect_encoding(head):
+    """
+    先頭サンプルからエンコーディングを1回で決める
+    BOM → UTF-8（非ASCIIを含み正しく読める場合）→ Shift_JIS（cp932拡張文字①・髙なども読む）
+    """
+    if head.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    if head.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if not head.isascii():
         try:
-            text = file_bytes.decode(enc)
-            break
-        except:
-            continue
-    else:
+            codecs.getincrementaldecoder('utf-8')().decode(head, final=False)
+            return 'utf-8'
+        except UnicodeDecodeError:
+            pass
+    try:
+        codecs.getincrementaldecoder('cp932')().decode(head, final=False)
+        return 'shift_jis'
+    except UnicodeDecodeError:
         raise ValueError("CSVのエンコーディングを判定できませんでした")
 
-    reader = csv.DictReader(io.StringIO(text))
-    records = []
-    
-    # 列名のマッピング（表記ゆれ対応）
-    col_map = {
-        '日付': ['日付', 'date', '取引日'],
-        '摘要': ['摘要', '内容', '取引内容', '摘　要'],
-        '入金': ['入金金額', '入金', '入金額'],
-        '出金': ['出金金額', '出金', '出金額'],
-        '残高': ['残高'],
-    }
-    
-    headers = reader.fieldnames or []
-    
-    def find_col(names):
-        for n in names:
-            if n in headers:
-                return n
-        return None
-    
-    col_date = find_col(col_map['日付'])
-    col_desc = find_col(col_map['摘要'])
-    col_in   = find_col(col_map['入金'])
-    col_out  = find_col(col_map['出金'])
-    col_bal  = find_col(col_map['残高'])
-    
-    if not col_date:
-        raise ValueError("日付列が見つかりません")
-    
-    for row in reader:
-        try:
-            date_str = row.get(col_date, '').strip().replace('"', '')
+class TextDecoder:
+    """
+    エンコーディングを固定した逐次デコーダ
+    サンプル以降で解釈できないバイトは U+FFFD に置き換える（行単位でエラー報告するため）
+    """
+
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._sjis = encoding == 'shift_jis'
+        self._decoder = codecs.getincrementaldecoder('cp932' if self._sjis else encoding)('replace')
+
+    def decode(self, data, final=False):
+        text = self._decoder.decode(data, final)
+        return text.translate(_CP932_TO_SJIS) if self._sjis else text
+
+def decode_csv_bytes(file_bytes):
+    """エンコーディングを自動判定して文字列にする"""
+    return TextDecoder(detect_encoding(file_bytes[:ENCODING_SAMPLE_SIZE])).decode(file_bytes, final=True)
+
+# 列名のマッピング（表記ゆれ対応）
+CSV_COLUMNS = {
+    '日付': ['日付', 'date', '取引日'],
+    '摘要': ['摘要', '内容', '取引内容', '摘　要'],
+    '入金': ['入金金額', '入金', '入金額'],
+    '出金': ['出金金額', '出金', '出金額'],
+    '残高': ['残高'],
+}
+
+def _to_int(val):
+    """金額文字列を整数に（数字だけの値は加工せずそのまま変換）"""
+    if val.isdigit() and val.isascii():
+        return int(val)
+    v = val.strip().replace(',', '').replace('"', '')
+    return int(v) if v else 0
+
+def _header_key(name):
+    """列名の比較用（全角/半角・前後の空白・引用符の違いを無視）"""
+    return unicodedata.normalize('NFKC', name).strip().strip('"').strip()
+
+class BankProfile:
+    """
+    銀行ごとの明細CSVの形式（列名の候補は先に書いたものを優先）
+    description: 摘要にする列（複数あれば空白でつなぐ）の候補リストのリスト
+    amount: 入出金が1列で符号付き（正=入金・負=出金）の銀行用（amount_in / amount_out の代わり）
+    footer: この文字列で始まる行は明細ではない（合計行など。日付エラーにも数えない）
+    strict: True ならすべての列がそろったときだけ採用、False なら日付列だけで採用（汎用）
+    """
+
+    def __init__(self, name, date, description=(), amount_in=(), amount_out=(), balance=(),
+                 amount=(), footer=(), strict=True):
+        self.name        = name
+        self.date        = tuple(date)
+        self.description = tuple(tuple(d) for d in description)
+        self.amount_in   = tuple(amount_in)
+        self.amount_out  = tuple(amount_out)
+        self.balance     = tuple(balance)
+        self.amount      = tuple(amount)
+        self.footer      = tuple(footer)
+        self.strict      = strict
+
+    def columns(self, headers):
+        """列位置（見つからない列は -1）。採用できないヘッダなら None"""
+        keys = [_header_key(h) for h in headers]
+
+        def find_col(names):
+            for n in names:
+                n = _header_key(n)
+                if n in keys:
+                    return len(keys) - 1 - keys[::-1].index(n)  # 同名の列は最後の列
+            return -1
+
+        cols = {
+            'date':        find_col(self.date),
+            'description': [find_col(d) for d in self.description],
+            'amount_in':   find_col(self.amount_in),
+            'amount_out':  find_col(self.amount_out),
+            'balance':     find_col(self.balance),
+            'amount':      find_col(self.amount),
+        }
+        if cols['date'] < 0:
+            return None
+        if self.strict:
+            wanted = [cols['date'], *cols['description'], cols['balance']]
+            wanted += [cols['amount']] if self.amount else [cols['amount_in'], cols['amount_out']]
+            if min(wanted) < 0:
+                return None
+        return cols
+
+    def compile(self, headers):
+        """
+        このヘッダ用の行デコーダを作る（ヘッダに合わなければ None）
+        csv.reader の行を列位置で読み、(日付文字列, 摘要, 入金, 出金, 残高) を返す（日付が空・フッター行は None）
+        摘要が欠けた行は ValueError、金額が欠けた列は 0
+        """
+        cols = self.columns(headers)
+        if cols is None:
+            return None
+        i_date = cols['date']
+        i_descs = [i for i in cols['description'] if i >= 0]
+        i_desc = i_descs[0] if len(i_descs) == 1 else -1
+        i_in, i_out, i_bal, i_amt = cols['amount_in'], cols['amount_out'], cols['balance'], cols['amount']
+        footer = self.footer
+
+        def decode_row(row):
+            n = len(row)
+            if i_date >= n:
+                return None
+            date_str = row[i_date].strip().replace('"', '')
             if not date_str:
-                continue
-            
-            # 日付パース（YYYYMMDD or YYYY/MM/DD or YYYY-MM-DD）
-            for fmt in ['%Y%m%d', '%Y/%m/%d', '%Y-%m-%d']:
+                return None
+            if footer and row[0].strip().startswith(footer):
+                return None
+            if len(i_descs) > 1:
+                if max(i_descs) >= n:
+                    raise ValueError("摘要列がありません")
+                desc = ' '.join(v for v in (row[i].strip() for i in i_descs) if v)
+            elif i_desc < 0:
+                desc = ''
+            elif i_desc < n:
+                desc = row[i_desc].strip()
+            else:
+                raise ValueError("摘要列がありません")
+            if i_amt >= 0:
+                amount = _to_int(row[i_amt]) if i_amt < n else 0
+                amount_in, amount_out = (amount, 0) if amount >= 0 else (0, -amount)
+            else:
+                amount_in  = _to_int(row[i_in])  if 0 <= i_in  < n else 0
+                amount_out = _to_int(row[i_out]) if 0 <= i_out < n else 0
+            return (date_str, desc, amount_in, amount_out,
+                    _to_int(row[i_bal]) if 0 <= i_bal < n else 0)
+
+        return decode_row
+
+# 銀行別の形式（上から順に照合し、最初に合ったものを使う。最後は列名の候補だけで判定する汎用形式）
+BANK_PROFILES = [
+    BankProfile('GMOあおぞらネット銀行',
+                date=['日付'], description=[['摘要']],
+                amount_in=['入金金額'], amount_out=['出金金額'], balance=['残高']),
+    BankProfile('ゆうちょ銀行',
+                date=['取引日'], description=[['詳細1'], ['詳細2']],
+                amount_in=['受入金額(円)', '受入金額'], amount_out=['払出金額(円)', '払出金額'],
+                balance=['現在(貸付)高', '現在高'], footer=['合計']),
+    BankProfile('三井住友銀行',
+                date=['年月日'], description=[['お取り扱い内容', 'お取扱内容']],
+                amount_in=['お預入れ', 'お預入'], amount_out=['お引出し', 'お引出'], balance=['残高']),
+    BankProfile('楽天銀行',
+                date=['取引日'], description=[['入出金内容']],
+                amount=['入出金(円)', '入出金'], balance=['取引後残高(円)', '取引後残高']),
+    BankProfile('汎用',
+                date=CSV_COLUMNS['日付'], description=[CSV_COLUMNS['摘要']],
+                amount_in=CSV_COLUMNS['入金'], amount_out=CSV_COLUMNS['出金'], balance=CSV_COLUMNS['残高'],
+                strict=False),
+]
+
+PROFILE_SEARCH_ROWS = 20    # ヘッダ行を探す行数（口座番号などの前置き行を読み飛ばす）
+
+def header_signature(headers):
+    """ヘッダ行のハッシュ（同じ形式のCSVなら同じ値）"""
+    return hashlib.sha1('\x1f'.join(_header_key(h) for h in headers).encode('utf-8')).hexdigest()[:16]
+
+_profile_cache = {}         # ヘッダ行のハッシュ → (BankProfile, 行デコーダ) または None
+_PROFILE_CACHE_SIZE = 256
+
+def register_profile(profile, index=None):
+    """銀行形式を追加（index 省略時は汎用形式の直前）。判定キャッシュは捨てる"""
+    BANK_PROFILES.insert(len(BANK_PROFILES) - 1 if index is None else index, profile)
+    _profile_cache.clear()
+
+def detect_profile(headers):
+    """
+    ヘッダ行に合う銀行形式と行デコーダを返す（どれにも合わなければ None）
+    結果はヘッダ行のハッシュごとに覚え、同じ形式の2回目以降は照合しない
+    """
+    key = header_signature(headers)
+    try:
+        return _profile_cache[key]
+    except KeyError:
+        pass
+    found = None
+    for profile in BANK_PROFILES:
+        decode_row = profile.compile(headers)
+        if decode_row is not None:
+            found = (profile, decode_row)
+            break
+    if len(_profile_cache) >= _PROFILE_CACHE_SIZE:
+        _profile_cache.clear()
+    _profile_cache[key] = found
+    return found
+
+# 日付形式（最初に読めた行で1ファイル1形式に決める）
+DATE_FORMATS = ['%Y%m%d', '%Y/%m/%d', '%Y-%m-%d']
+
+def _fast_date_decoder(fmt):
+    """strptime を使わず整数スライスで日付を読む関数を返す（読めなければ None）"""
+    if fmt == '%Y%m%d':
+        def decode(s):
+            if len(s) != 8 or not s.isdigit():
+                return None
+            try:
+                return datetime(int(s[:4]), int(s[4:6]), int(s[6:]))
+            except ValueError:
+                return None
+        return decode
+
+    sep = fmt[2]
+    def decode(s):
+        parts = s.split(sep)
+        if len(parts) != 3:
+            return None
+        y, m, d = parts
+        if len(y) != 4 or not (0 < len(m) <= 2 and 0 < len(d) <= 2) or not (y + m + d).isdigit():
+            return None
+        try:
+            return datetime(int(y), int(m), int(d))
+        except ValueError:
+            return None
+    return decode
+
+class DateParser:
+    """
+    ファイル単位の日付デコーダ
+    最初に読めた行で形式を決め、以降はその形式専用のデコーダで変換（同じ日付文字列はキャッシュ）
+    形式に合わない行は strptime で読み直して mismatch_count に、どの形式でも読めない行は invalid に数える
+    """
+
+    MAX_REPORTED_ERRORS = 100
+
+    def __init__(self):
+        self.format = None
+        self.mismatch_count = 0
+        self.invalid_count = 0
+        self.invalid_lines = []
+        self._decode = None
+        self._cache = {}  # 日付文字列 → (datetime, 検出形式に一致したか)
+
+    def parse(self, s, line_no=None):
+        cached = self._cache.get(s)
+        if cached is not None:
+            dt, matched = cached
+            if not matched:
+                self.mismatch_count += 1
+            return dt
+
+        dt = self._decode(s) if self._decode else None
+        matched = dt is not None
+        if dt is None:
+            for fmt in DATE_FORMATS:
                 try:
-                    dt = datetime.strptime(date_str, fmt)
+                    dt = datetime.strptime(s, fmt)
                     break
-                except:
+                except ValueError:
                     continue
             else:
+                self.invalid_count += 1
+                if line_no is not None and len(self.invalid_lines) < self.MAX_REPORTED_ERRORS:
+                    self.invalid_lines.append(line_no)
+                return None
+            if self._decode is None:
+                self.format = fmt
+                self._decode = _fast_date_decoder(fmt)
+                matched = True
+            else:
+                self.mismatch_count += 1
+
+        self._cache[s] = (dt, matched)
+        return dt
+
+class BankCsvReader:
+    """
+    銀行明細CSVをバイトストリームから少しずつデコードし、レコードを1件ずつ返すイテレータ
+    レコードはファイルの順に返す。読み終えた後の in_order で日付順だったかが分かる
+    デコードできなかったバイトを含む行は decode_errors（行番号）に記録する
+    seen（指紋のリスト → そのうち取込済みの set を返す関数。FingerprintStore.lookup）を渡すと差分取込: 未取込の行がある月だけを（その月の取込済み行も含めて）返し、
+    取込済みの行しかない月は科目判定の前に捨てる
+    """
+
+    CHUNK_SIZE  = 64 * 1024
+    BATCH_SIZE  = 2000        # 科目判定をまとめる行数
+    MAX_REPORTED_ERRORS = 100
+
+    def __init__(self, stream, index=None, stats=None, seen=None):
+        self.stream = stream
+        self.index = index or get_rule_index()
+        self.similar = self.index.similar.fork()  # このファイルで判定できた摘要だけを類似推定に使う
+        self.stats = stats
+        self.seen = seen            # 取込済み指紋を調べる関数（指定時は差分取込）
+        self.new_fingerprints = []  # 未取込だった行の (指紋, 月番号)
+        self.skipped_rows = 0       # 取込済みとして読み飛ばした行数
+        self.affected_months = []   # 未取込の行があった (年, 月)
+        self.encoding = None
+        self.in_order = True
+        self.decode_errors = []     # 文字化けした行番号（先頭 MAX_REPORTED_ERRORS 件）
+        self.decode_error_count = 0
+        self.dates = DateParser()   # 日付形式・形式違い／読めない日付の行
+        self.profile = None         # 判定した銀行形式（BankProfile）
+        self.header_signature = None
+        self._records = self._iter_records()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self._records)
+
+    def read_all(self):
+        """全件を日付順のリストで返す（ファイルが日付順なら並べ替えない）"""
+        records = list(self)
+        if not self.in_order:
+            records.sort(key=lambda x: x.date)
+        return records
+
+    def read_table(self):
+        """全件を日付順に読み、列指向の TransactionTable で返す"""
+        return TransactionTable(self.read_all())
+
+    def _iter_lines(self):
+        """行単位（改行付き）で文字列を返す"""
+        head = self.stream.read(ENCODING_SAMPLE_SIZE)
+        self.encoding = detect_encoding(head)
+        decoder = TextDecoder(self.encoding)
+
+        buf, chunk, line_no = '', head, 0
+        while True:
+            final = not chunk
+            buf += decoder.decode(chunk, final=final)
+            *lines, buf = buf.split('\n')
+            if final and buf:
+                lines.append(buf)
+            for line in lines:
+                line_no += 1
+                if '\ufffd' in line:
+                    self._decode_error(line_no)
+                yield line + '\n'
+            if final:
+                break
+            chunk = self.stream.read(self.CHUNK_SIZE)
+
+    def _decode_error(self, line_no):
+        self.decode_error_count += 1
+        if len(self.decode_errors) < self.MAX_REPORTED_ERRORS:
+            self.decode_errors.append(line_no)
+
+    def _iter_records(self):
+        reader = csv.reader(self._iter_lines())
+        for headers in reader:
+            found = detect_profile(headers)
+            if found or reader.line_num >= PROFILE_SEARCH_ROWS:
+                break
+        else:
+            found = None
+        if not found:
+            raise ValueError("日付列が見つかりません")
+        self.profile, decode_row = found
+        self.header_signature = header_signature(headers)
+
+        held, affected = defaultdict(list), set()
+        pending = []
+        last_date = None
+        rows = self._iter_transactions(reader, decode_row)
+        if self.seen is not None:
+            rows = self._check_seen(rows)
+        for rec in rows:
+            if self.seen is not None:
+                rec, fp, month, is_seen = rec
+                if is_seen:
+                    if month not in affected:
+                        held[month].append(rec)  # この月に未取込の行が出てくるまで保留
+                        continue
+                else:
+                    self.new_fingerprints.append((fp, month))
+                    if month not in affected:
+                        affected.add(month)
+                        earlier = held.pop(month, None)
+                        if earlier:
+                            pending.extend(earlier)
+                            self.in_order = False
+
+            dt = rec.date
+            if last_date is not None and dt < last_date:
+                self.in_order = False
+            last_date = dt
+
+            pending.append(rec)
+            if len(pending) >= self.BATCH_SIZE:
+                yield from self._classify(pending)
+                pending = []
+
+        yield from self._classify(pending)
+        if self.seen is not None:
+            self.skipped_rows = sum(len(v) for v in held.values())
+            self.affected_months = [(m // 12, m % 12 + 1) for m in sorted(affected)]
+
+    def _iter_transactions(self, reader, decode_row):
+        """CSVの行を Transaction にして返す（日付の読めない行・明細でない行は飛ばす）"""
+        parse_date = self.dates.parse
+        for row in reader:
+            try:
+                fields = decode_row(row)
+                if fields is None:
+                    continue
+                date_str, desc, amount_in, amount_out, balance = fields
+
+                # 日付パース（YYYYMMDD or YYYY/MM/DD or YYYY-MM-DD）
+                dt = parse_date(date_str, reader.line_num)
+                if dt is None:
+                    continue
+            except Exception as e:
                 continue
-            
-            desc = row.get(col_desc, '').strip()
-            
-            def to_int(val):
-                v = str(val or '').strip().replace(',', '').replace('"', '')
-                return int(v) if v else 0
-            
-            amount_in  = to_int(row.get(col_in, 0))
-            amount_out = to_int(row.get(col_out, 0))
-            balance    = to_int(row.get(col_bal, 0))
-            
-            subject, sub_subject, category, g_label = guess_subject(desc, amount_in, amount_out)
-            records.append({
-                'date': dt,
-                'year': dt.year,
-                'month': dt.month,
-                'day': dt.day,
-                'description': desc,
-                'amount_in': amount_in,
-                'amount_out': amount_out,
-                'balance': balance,
-                'subject': subject,
-                'sub_subject': sub_subject,
-                'category': category,
-                'g_label': g_label,
-            })
-        except Exception as e:
+            yield Transaction(dt, desc, amount_in, amount_out, balance)
+
+    def _check_seen(self, records):
+        """
+        (明細, 指紋, 月番号, 取込済みか) を返す
+        指紋は BATCH_SIZE 行ずつまとめて seen（FingerprintStore.lookup）に問い合わせる
+        """
+        occurrences = {}
+        for block in iter(lambda: list(islice(records, self.BATCH_SIZE)), []):
+            keyed = []
+            for rec in block:
+                dt = rec.date
+                key = (dt, rec.description, rec.amount_in, rec.amount_out, rec.balance)
+                occurrence = occurrences[key] = occurrences.get(key, -1) + 1
+                keyed.append((rec, row_fingerprint(*key, occurrence), dt.year * 12 + dt.month - 1))
+            found = self.seen([fp for _, fp, _ in keyed])
+            for rec, fp, month in keyed:
+                yield rec, fp, month, fp in found
+
+    def _classify(self, records):
+        """科目付与（同一摘要はまとめて1回だけ判定）"""
+        results = classify_batch([r.description for r in records],
+                                 [r.amount_in for r in records],
+                                 [r.amount_out for r in records],
+                                 self.index, self.stats, self.similar)
+        for rec, label in zip(records, results):
+            rec.label_id = intern_label(label)
+        return records
+
+def iter_bank_csv(stream, index=None, stats=None, seen=None):
+    """
+    銀行明細CSV（バイナリのファイルオブジェクト）を逐次解析し、レコードを1件ずつ返す
+    index: 使用する RuleIndex / stats: ルールヒット集計の記録先（RuleStats）/ seen: 差分取込用の取込済み指紋の照会（FingerprintStore.lookup）
+    """
+    return BankCsvReader(stream, index, stats, seen)
+
+def parse_bank_csv(file_bytes, index=None, stats=None):
+    """
+    銀行明細CSVを解析して日付順のデータリストを返す
+    file_bytes: bytes またはバイナリのファイルオブジェクト
+    """
+    stream = io.BytesIO(file_bytes) if isinstance(file_bytes, (bytes, bytearray)) else file_bytes
+    return iter_bank_csv(stream, index, stats).read_all()
+
+# =====================================================
+# 複数ファイルの一括変換（ZIP展開・並列解析・日付順マージ）
+# =====================================================
+PARSE_WORKERS = int(os.environ.get('PARSE_WORKERS', min(4, os.cpu_count() or 1)))
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+def get_parse_pool():
+    """解析・月別シート作成用のプロセスプール（初回に起動。spawn なので Flask のスレッドや接続を子に持ち込まない）"""
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None:
+            _parse_pool = ProcessPoolExecutor(PARSE_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _parse_pool
+
+def _discard_parse_pool():
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is not None:
+            _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+def expand_uploads(files):
+    """
+    (ファイル名, バイト列 or バイナリストリーム) のリストを CSV 単位に展開する
+    ZIP は中の .csv を名前順に取り出す（フォルダ・隠しファイル・__MACOSX は除く）
+    """
+    out = []
+    for name, data in files:
+        head = data[:4] if isinstance(data, (bytes, bytearray)) else data.read(4)
+        if not isinstance(data, (bytes, bytearray)):
+            data.seek(0)
+        if head != b'PK\x03\x04':
+            out.append((name, data))
             continue
-    
-    return sorted(records, key=lambda x: x['date'])
+        with zipfile.ZipFile(io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data) as zf:
+            for info in sorted(zf.infolist(), key=lambda i: i.filename):
+                base = info.filename.rsplit('/', 1)[-1]
+                if (info.is_dir() or info.filename.startswith('__MACOSX/') or base.startswith('.')
+                        or not base.lower().endswith('.csv')):
+                    continue
+                out.append((f"{name}/{info.filename}", zf.read(info)))
+    return out
+
+def parse_upload(name, data, index=None, incremental=False, rule_version=None):
+    """
+    1ファイルを解析して (日付順のレコード, 読み取り情報, RuleStats) を返す
+    プロセスプールの子プロセスからも呼ばれる（上書き表は親が更新していれば読み直す）
+    incremental: 取込済みの行しかない月を捨てる（指紋の登録は呼び出し側が変換の成功後に行う）
+    rule_version: index を渡せない子プロセス用。手元の辞書の版が違えば読み直す（使った版は info['rule_version']）
+    """
+    CORRECTIONS.refresh()
+    if index is None and rule_version is not None:
+        index = get_rule_index()
+        if index.version != rule_version:
+            index = reload_rules()
+    stats = RuleStats()
+    stream = io.BytesIO(data) if isinstance(data, (bytes, bytearray)) else data
+    reader = iter_bank_csv(stream, index, stats, FINGERPRINTS.lookup if incremental else None)
+    try:
+        records = reader.read_all()
+    except ValueError as e:
+        raise ValueError(f"{name}: {e}") from None
+    info = {
+        'name': name,
+        'records': len(records),
+        'rule_version': reader.index.version,
+        'encoding': reader.encoding,
+        'profile': reader.profile.name,
+        'header_signature': reader.header_signature,
+        'decode_error_count': reader.decode_error_count,
+        'decode_errors': reader.decode_errors,
+        'date_format': reader.dates.format,
+        'date_mismatch_count': reader.dates.mismatch_count,
+        'date_invalid_count': reader.dates.invalid_count,
+        'date_invalid_lines': reader.dates.invalid_lines,
+        'skipped_rows': reader.skipped_rows,
+        'affected_months': reader.affected_months,
+        'new_fingerprints': reader.new_fingerprints,
+        'similar_timeouts': reader.similar.timeouts,
+    }
+    return records, info, stats
+
+def parse_uploads(files, index=None, stats=None, incremental=False):
+    """
+    複数の銀行明細CSVを解析し、日付順に1本にした (レコードのリスト, ファイル別の読み取り情報) を返す
+    2ファイル以上なら PARSE_WORKERS 個のプロセスで並列に解析する（incremental は parse_upload と同じ）
+    各ファイルの結果は日付順なので heapq.merge で併合するだけ（全体の並べ替えはしない。同じ日付はファイル順）
+    """
+    index = index or get_rule_index()  # 全ファイルをこの辞書で判定する（子プロセスには版を渡す）
+    results = None
+    if len(files) > 1 and PARSE_WORKERS > 1:
+        files = [(name, data if isinstance(data, (bytes, bytearray)) else data.read()) for name, data in files]
+        try:
+            pool = get_parse_pool()
+            futures = [pool.submit(parse_upload, name, data, None, incremental, index.version)
+                       for name, data in files]
+            results = [f.result() for f in futures]
+        except BrokenProcessPool as e:
+            print(f"⚠️ 並列解析に失敗したため順に解析します: {e}")
+            _discard_parse_pool()
+            results = None
+        else:
+            for i, ((name, data), (_, info, job_stats)) in enumerate(zip(files, results)):
+                if info['rule_version'] != index.version:
+                    # 辞書の更新と重なり、子プロセスが別の版で判定した → このリクエストの辞書で判定し直す
+                    print(f"⚠️ {name}: 辞書 v{info['rule_version']} で判定されたため v{index.version} で解析し直します")
+                    results[i] = parse_upload(name, data, index, incremental)
+                else:
+                    CLASSIFY_STATS.merge(job_stats)  # 子プロセスの集計は親の累計に入らないため
+    if results is None:
+        results = [parse_upload(name, data, index, incremental) for name, data in files]
+
+    if stats is not None:
+        for _, _, job_stats in results:
+            stats.merge(job_stats)
+    streams = [records for records, _, _ in results]
+    records = streams[0] if len(streams) == 1 else list(heapq.merge(*streams, key=attrgetter('date')))
+    return records, [info for _, info, _ in results]
 
 # =====================================================
 # Excel生成（既存GMO形式に準拠）
@@ -404,261 +1755,380 @@ MONTHS_JP = {
     9:'9月', 10:'10月', 11:'11月', 12:'12月'
 }
 
-def build_excel(records):
-    """月別シートのExcelを生成"""
-    wb = openpyxl.Workbook()
-    wb.remove(wb.active)  # デフォルトシート削除
-    
-    # 月別にグループ化
+# 月別シートの見た目（標準・書き込み専用のどちらのエンジンでも同じ）
+MONTH_HEADERS = ['日付', '摘　要', '出　　金', '入　　金', '残　　高', '科　目', '大分類  >  中分類（補助）']
+MONTH_COLUMN_WIDTHS = {'A': 5, 'B': 22, 'C': 11, 'D': 11, 'E': 11, 'F': 14, 'G': 22}
+
+# G列の文字色（大分類ごと。ARGB形式（FF+RGBの8桁）で指定しないと透明になる）
+G_COLORS = [('収入', 'FF375623'), ('仕入', 'FF1F3864'), ('外注', 'FF7F6000'), ('人件', 'FFC55A11'),
+            ('金融', 'FFC00000'), ('固定', 'FF4A148C'), ('振替', 'FF666666')]
+G_COLOR_DEFAULT = 'FF444444'
+
+# 書き込み専用エンジン（openpyxl の write_only）に切り替える明細件数
+WRITE_ONLY_THRESHOLD = int(os.environ.get('WRITE_ONLY_THRESHOLD', 20000))
+
+# ===== 書式オブジェクトの共有 =====
+# 同じ指定の Font / PatternFill / Alignment / Border はプロセス内で1つだけ作り、全シート・全セルで使い回す
+# （書式オブジェクトは変更しないこと。セルの書式を変えるときは別の指定で取り直す）
+@lru_cache(maxsize=None)
+def cell_font(**kwargs):
+    return Font(**kwargs)
+
+@lru_cache(maxsize=None)
+def solid_fill(color):
+    return PatternFill('solid', start_color=color, end_color=color)
+
+@lru_cache(maxsize=None)
+def cell_alignment(**kwargs):
+    return Alignment(**kwargs)
+
+@lru_cache(maxsize=None)
+def thin_border(color):
+    """上下左右の細線"""
+    thin = Side(border_style='thin', color=color)
+    return Border(left=thin, right=thin, top=thin, bottom=thin)
+
+class StyleRegistry:
+    """
+    ブック内の書式番号の表 {書式名: StyleArray}
+    書式名ごとに最初のセルだけ Font などを登録し、以降のセルには登録済みの番号を写すだけにする
+    （openpyxl は書式を代入するたびにオブジェクトをハッシュしてブックの一覧と照合するため、行数が多いと重い）
+    """
+    def __init__(self, specs):
+        self.specs = specs
+        self._arrays = {}
+        self._ids = {}
+
+    def apply(self, cell, name):
+        array = self._arrays.get(name)
+        if array is None:
+            _apply_style(cell, self.specs[name])
+            self._arrays[name] = copy(cell._style)
+        else:
+            cell._style = copy(array)
+
+    def style_id(self, ws, name):
+        """書式名のセル書式番号（styles.xml の cellXfs の位置。シートのXMLを直接書くとき用）"""
+        style_id = self._ids.get(name)
+        if style_id is None:
+            cell = WriteOnlyCell(ws)
+            self.apply(cell, name)
+            style_id = self._ids[name] = cell.style_id
+        return style_id
+
+@lru_cache(maxsize=None)
+def month_styles():
+    """月別シートの書式 {名前: (font, fill, border, alignment, number_format)}（None は既定のまま）"""
+    data_font   = cell_font(name='Arial', size=10)
+    bold_font   = cell_font(bold=True, name='Arial', size=10)
+    title_fill  = solid_fill('4472C4')
+    header_fill = solid_fill('BDD7EE')
+    carry_fill  = solid_fill('E2EFDA')
+    total_fill  = solid_fill('FCE4D6')
+
+    border = thin_border('AAAAAA')
+
+    center = cell_alignment(horizontal='center', vertical='center')
+    right  = cell_alignment(horizontal='right', vertical='center')
+    left   = cell_alignment(horizontal='left', vertical='center')
+
+    money_fmt = '#,##0'
+    date_fmt  = '0'
+
+    styles = {
+        'title':         (cell_font(bold=True, name='Arial', size=13, color='FFFFFFFF'), title_fill, None, center, None),
+        'header':        (cell_font(bold=True, name='Arial', size=10, color='FF1F3864'), header_fill, border, center, None),
+        'carry':         (None, carry_fill, border, None, None),
+        'carry_label':   (bold_font, carry_fill, border, left, None),
+        'carry_balance': (bold_font, carry_fill, border, right, money_fmt),
+        'day':           (data_font, None, border, center, date_fmt),
+        'description':   (data_font, None, border, left, None),
+        'money':         (data_font, None, border, right, money_fmt),
+        'subject':       (cell_font(name='Arial', size=9, color='1F3864'), None, border, left, None),
+        'no_subject':    (cell_font(name='Arial', size=9, color='BBBBBB'), None, border, left, None),
+        'total':         (None, total_fill, border, None, None),
+        'total_label':   (bold_font, total_fill, border, center, None),
+        'total_money':   (bold_font, total_fill, border, right, money_fmt),
+        'total_balance': (cell_font(bold=True, name='Arial', size=10, color='FFC00000'), total_fill, border, right, money_fmt),
+    }
+    for color in [c for _, c in G_COLORS] + [G_COLOR_DEFAULT]:
+        styles['g_' + color] = (cell_font(name='Arial', size=10, color=color), None, border, left, None)
+    return styles
+
+def g_style(category):
+    """G列の書式名（大分類ごとに文字色を変える）"""
+    for key, color in G_COLORS:
+        if key in category:
+            return 'g_' + color
+    return 'g_' + G_COLOR_DEFAULT
+
+def balance_before(rec):
+    """明細 rec の直前の残高（残高と入出金から逆算）"""
+    if rec['amount_in']:
+        return rec['balance'] - rec['amount_in']
+    if rec['amount_out']:
+        return rec['balance'] + rec['amount_out']
+    return 0
+
+def month_sheet_name(index, year, month):
+    """
+    月別シート名（index: 最初の月を 0 とする通し番号）
+    頭の記号は集計シート A〜C の続きで D, E, …, Z, AA, AB, …（Excel の列名と同じ数え方）
+    """
+    return f"{get_column_letter(index + 4)}. {year}年{MONTHS_JP[month]}"
+
+def opening_balances(by_month):
+    """
+    月別シートの前月繰越残高 {(年, 月): 残高}
+    前月のシートがあればその最終残高、無ければ（最初の月・明細の無い月の翌月）最初の明細から逆算
+    """
+    balances = {}
+    carried = {}
+    for (year, month) in sorted(by_month):
+        month_records = by_month[(year, month)]
+        prev_bal = carried.get((year, month))
+        if prev_bal is None:
+            prev_bal = balance_before(month_records[0]) if month_records else 0
+        balances[(year, month)] = prev_bal
+        if month_records:
+            next_ym = (year, month + 1) if month < 12 else (year + 1, 1)
+            carried[next_ym] = month_records[-1]['balance']
+    return balances
+
+class Formula(str):
+    """Excel の数式（'=' で始まる文字列）と、Python で求めたその計算結果 result"""
+    def __new__(cls, text, result):
+        formula = super().__new__(cls, text)
+        formula.result = result
+        return formula
+
+def month_sheet_rows(year, month, month_records, prev_bal, values_only=False):
+    """
+    月別シートの中身を上の行から順に返す: (行番号, 行の高さ, [(列, 値, 書式名), ...])
+    残高・合計の数式は計算結果を持つ Formula で返す（values_only なら計算結果の数値だけ）
+    """
+    def formula(text, result):
+        return result if values_only else Formula(text, result)
+
+    # ===== 行1: タイトル =====
+    yield 1, 22, [(1, f"E-MEITA仕訳Excel　{year}年{month}月", 'title')]
+
+    # ===== 行2: ヘッダー =====
+    yield 2, 18, [(col, h, 'header') for col, h in enumerate(MONTH_HEADERS, 1)]
+
+    # ===== 行3: 前月繰越残高 =====
+    yield 3, 16, [(1, None, 'carry'), (2, '前月繰越', 'carry_label'), (3, None, 'carry'), (4, None, 'carry'),
+                  (5, prev_bal, 'carry_balance'), (6, None, 'carry'), (7, None, 'carry')]
+
+    # ===== 行4以降: 明細データ（month_records はイテレータでもよい）=====
+    data_start_row = 4
+    row = data_start_row - 1
+    balance = prev_bal
+    total_in = total_out = 0
+    for row, rec in enumerate(month_records, data_start_row):
+        amount_in, amount_out = rec['amount_in'], rec['amount_out']
+        # E: 残高（Excel数式）。最初の行は前月繰越 + 入金 - 出金
+        balance += (amount_in if amount_in > 0 else 0) - (amount_out if amount_out > 0 else 0)
+        total_in += amount_in
+        total_out += amount_out
+        subject = rec.get('subject', '')
+        yield row, 15, [
+            (1, rec['day'], 'day'),                                      # A: 日付（日だけ）
+            (2, rec['description'], 'description'),                      # B: 摘要
+            (3, amount_out if amount_out else None, 'money'),            # C: 出金
+            (4, amount_in if amount_in else None, 'money'),              # D: 入金
+            (5, formula(f"=E{row - 1}+IF(D{row}>0,D{row},0)-IF(C{row}>0,C{row},0)", balance), 'money'),  # E: 残高
+            (6, subject, 'subject' if subject else 'no_subject'),        # F: 科目（シンプル表記）
+            # G: 2階層カテゴリ「🟢 収入  >  売上収入（馬主・育成）」
+            (7, rec.get('g_label', ''), g_style(rec.get('category', ''))),
+        ]
+
+    # ===== 合計行 =====
+    if row >= data_start_row:
+        last_data_row = row
+        yield last_data_row + 1, 18, [
+            (1, '合　計', 'total_label'),
+            (3, formula(f'=SUM(C{data_start_row}:C{last_data_row})', total_out), 'total_money'),  # 出金合計
+            (4, formula(f'=SUM(D{data_start_row}:D{last_data_row})', total_in), 'total_money'),   # 入金合計
+            (5, formula(f'=E{last_data_row}', balance), 'total_balance'),                        # 月末残高
+            (6, None, 'total'), (7, None, 'total'),
+        ]
+
+def _apply_style(cell, style):
+    font, fill, border, alignment, number_format = style
+    if font is not None:
+        cell.font = font
+    if fill is not None:
+        cell.fill = fill
+    if border is not None:
+        cell.border = border
+    if alignment is not None:
+        cell.alignment = alignment
+    if number_format is not None:
+        cell.number_format = number_format
+
+def write_month_sheet(ws, year, month, month_records, prev_bal, styles=None, values_only=False):
+    """
+    月別シートを書く（ws が書き込み専用ワークブックのシートなら行を順に append する）
+    styles: ブック内で共有する StyleRegistry（省略時はこのシートだけで作る）
+    values_only: 残高・合計を数式ではなく計算済みの数値で書く
+    数式セルの計算結果を {セル番地: 値} で返す（openpyxl は計算結果を書かないので save_workbook_bytes で入れる）
+    """
+    styles = styles or StyleRegistry(month_styles())
+    write_only = ws.parent.write_only
+    results = {}
+
+    # 書き込み専用では列幅・表示設定を行より先に決める必要がある
+    # ===== 列幅設定（A〜G全列が1画面に収まるよう設定）=====
+    for col, width in MONTH_COLUMN_WIDTHS.items():
+        ws.column_dimensions[col].width = width
+
+    # ズーム80%に設定（全列が見えるよう）
+    ws.sheet_view.zoomScale = 80
+
+    # ヘッダー行を固定（スクロールしても1・2行目が常に見える）
+    ws.freeze_panes = 'A3'
+
+    # 印刷設定
+    ws.page_setup.orientation = 'landscape'
+    ws.page_setup.paperSize = 9  # A4
+    ws.print_title_rows = '1:2'
+
+    # タイトル行と合計行（A:B）の結合
+    merges = ['A1:G1']
+    if month_records:
+        total_row = 4 + len(month_records)
+        merges.append(f'A{total_row}:B{total_row}')
+    for ref in merges:
+        if write_only:
+            ws.merged_cells.add(ref)
+        else:
+            ws.merge_cells(ref)
+
+    for row, height, cells in month_sheet_rows(year, month, month_records, prev_bal, values_only):
+        for col, value, _ in cells:
+            if isinstance(value, Formula):
+                results[f'{get_column_letter(col)}{row}'] = value.result
+        if write_only:
+            ws.row_dimensions[row].height = height
+            values = [None] * len(MONTH_HEADERS)
+            for col, value, style in cells:
+                cell = WriteOnlyCell(ws, value=value)
+                styles.apply(cell, style)
+                values[col - 1] = cell
+            ws.append(values)
+            del ws.row_dimensions[row]  # 書き出した行の情報は持ち続けない
+        else:
+            for col, value, style in cells:
+                styles.apply(ws.cell(row=row, column=col, value=value), style)
+            ws.row_dimensions[row].height = height
+    return results
+
+def copy_sheet_write_only(src, wb):
+    """通常のシート src を書き込み専用ワークブック wb の末尾に写す（集計シートなど行数の少ないもの用）"""
+    ws = wb.create_sheet(title=src.title)
+    for key, dim in src.column_dimensions.items():
+        if dim.width:
+            ws.column_dimensions[key].width = dim.width
+    if src.sheet_view.zoomScale:
+        ws.sheet_view.zoomScale = src.sheet_view.zoomScale
+    if src.freeze_panes:
+        ws.freeze_panes = src.freeze_panes
+    ws.page_setup.orientation = src.page_setup.orientation
+    ws.page_setup.paperSize = src.page_setup.paperSize
+    if src.print_title_rows:
+        ws.print_title_rows = src.print_title_rows
+
+    rows = defaultdict(list)
+    for (row, col), cell in src._cells.items():
+        rows[row].append((col, cell))
+    for row in range(1, src.max_row + 1):
+        height = src.row_dimensions[row].height if row in src.row_dimensions else None
+        if height is not None:
+            ws.row_dimensions[row].height = height
+        values = [None] * src.max_column
+        for col, cell in rows.get(row, ()):
+            new = WriteOnlyCell(ws, value=cell.value)
+            if cell.has_style:
+                new.font, new.fill, new.border = copy(cell.font), copy(cell.fill), copy(cell.border)
+                new.alignment, new.protection = copy(cell.alignment), copy(cell.protection)
+                new.number_format = cell.number_format
+            values[col - 1] = new
+        ws.append(values)
+        if height is not None:
+            del ws.row_dimensions[row]
+    for merged in src.merged_cells.ranges:
+        ws.merged_cells.add(merged.coord)
+    return ws
+
+def build_excel(records, rule_version=None, rule_stats=None, write_only=None, values_only=False):
+    """
+    月別シートのExcelを生成
+    rule_version: 仕訳に使った辞書のバージョン / rule_stats: RuleStats.report() の結果（診断シートを追加）
+    write_only: True で書き込み専用エンジン（セルを保持せずに行ごとに書き出す。保存は1回だけ）
+                None なら明細が WRITE_ONLY_THRESHOLD 件を超えるとき書き込み専用にする
+    values_only: 月別シートの残高・合計を数式ではなく計算済みの数値で書く
+    """
+    # 月別にグループ化（records は TransactionTable や iter_bank_csv のイテレータでもよい。日付順であること）
+    table = records if isinstance(records, TransactionTable) else None
     by_month = defaultdict(list)
     years = set()
-    for r in records:
+    all_records = []
+    for r in (table.records if table else records):
         by_month[(r['year'], r['month'])].append(r)
         years.add(r['year'])
-    
-    # スタイル定義
-    header_font = Font(bold=True, name='Arial', size=11)
-    data_font   = Font(name='Arial', size=10)
-    title_fill  = PatternFill('solid', start_color='4472C4', end_color='4472C4')
-    header_fill = PatternFill('solid', start_color='BDD7EE', end_color='BDD7EE')
-    carry_fill  = PatternFill('solid', start_color='E2EFDA', end_color='E2EFDA')
-    total_fill  = PatternFill('solid', start_color='FCE4D6', end_color='FCE4D6')
-    
-    thin = Side(border_style='thin', color='AAAAAA')
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    
-    center = Alignment(horizontal='center', vertical='center')
-    right  = Alignment(horizontal='right', vertical='center')
-    left   = Alignment(horizontal='left', vertical='center')
-    
-    money_fmt = '#,##0'
-    date_fmt  = '0'
+        all_records.append(r)
+    records = all_records
+    if table is None:
+        table = TransactionTable(records)
+    if write_only is None:
+        write_only = len(records) > WRITE_ONLY_THRESHOLD
+
+    wb = openpyxl.Workbook(write_only=write_only)
+    if not write_only:
+        wb.remove(wb.active)  # デフォルトシート削除
+    if rule_version is not None:
+        wb.custom_doc_props.append(StringProperty(name='RuleVersion', value=rule_version))
     
     # 月の順番でシート作成
     sorted_months = sorted(by_month.keys())
-    
-    # 前月末残高を追跡
-    prev_balance = {}
-    
-    for ym in sorted_months:
-        year, month = ym
-        month_records = by_month[ym]
-        # D以降のアルファベットは sorted_months のインデックスで決定
-        alpha = chr(ord("D") + sorted_months.index(ym))
-        sheet_name = f"{alpha}. {year}年{MONTHS_JP[month]}"
-        ws = wb.create_sheet(title=sheet_name)
-        
-        # ===== 行1: タイトル =====
-        ws.merge_cells('A1:G1')
-        title_cell = ws['A1']
-        title_cell.value = f"E-MEITA仕訳Excel　{year}年{month}月"
-        title_cell.font = Font(bold=True, name='Arial', size=13, color='FFFFFFFF')
-        title_cell.fill = title_fill
-        title_cell.alignment = center
-        ws.row_dimensions[1].height = 22
-        
-        # ===== 行2: ヘッダー =====
-        headers = ['日付', '摘　要', '出　　金', '入　　金', '残　　高', '科　目', '大分類  >  中分類（補助）']
-        for col, h in enumerate(headers, 1):
-            cell = ws.cell(row=2, column=col, value=h)
-            cell.font = Font(bold=True, name='Arial', size=10, color='FF1F3864')
-            cell.fill = header_fill
-            cell.alignment = center
-            cell.border = border
-        ws.row_dimensions[2].height = 18
-        
-        # ===== 行3: 前月繰越残高 =====
-        prev_bal = prev_balance.get((year, month), None)
-        if prev_bal is None:
-            # 最初の月は最初のレコードの前残高を推定
-            if month_records:
-                first = month_records[0]
-                if first['amount_in']:
-                    prev_bal = first['balance'] - first['amount_in']
-                elif first['amount_out']:
-                    prev_bal = first['balance'] + first['amount_out']
-                else:
-                    prev_bal = 0
-            else:
-                prev_bal = 0
-        
-        ws['A3'] = None
-        ws['B3'] = '前月繰越'
-        ws['B3'].font = Font(bold=True, name='Arial', size=10)
-        ws['B3'].fill = carry_fill
-        ws['B3'].alignment = left
-        ws['B3'].border = border
-        
-        ws['E3'] = prev_bal
-        ws['E3'].number_format = money_fmt
-        ws['E3'].font = Font(bold=True, name='Arial', size=10)
-        ws['E3'].fill = carry_fill
-        ws['E3'].alignment = right
-        ws['E3'].border = border
-        
-        for c in [1, 3, 4, 6, 7]:
-            cell = ws.cell(row=3, column=c)
-            cell.fill = carry_fill
-            cell.border = border
-        
-        ws.row_dimensions[3].height = 16
-        
-        # ===== 行4以降: 明細データ =====
-        data_start_row = 4
-        
-        for i, rec in enumerate(month_records):
-            row = data_start_row + i
-            
-            # A: 日付（日だけ）
-            cell_a = ws.cell(row=row, column=1, value=rec['day'])
-            cell_a.font = data_font
-            cell_a.alignment = center
-            cell_a.border = border
-            cell_a.number_format = date_fmt
-            
-            # B: 摘要
-            cell_b = ws.cell(row=row, column=2, value=rec['description'])
-            cell_b.font = data_font
-            cell_b.alignment = left
-            cell_b.border = border
-            
-            # C: 出金
-            cell_c = ws.cell(row=row, column=3, value=rec['amount_out'] if rec['amount_out'] else None)
-            cell_c.font = data_font
-            cell_c.alignment = right
-            cell_c.border = border
-            cell_c.number_format = money_fmt
-            
-            # D: 入金
-            cell_d = ws.cell(row=row, column=4, value=rec['amount_in'] if rec['amount_in'] else None)
-            cell_d.font = data_font
-            cell_d.alignment = right
-            cell_d.border = border
-            cell_d.number_format = money_fmt
-            
-            # E: 残高（Excel数式）
-            if i == 0:
-                # 最初の行: 前月繰越 + 入金 - 出金
-                formula = f"=E3+IF(D{row}>0,D{row},0)-IF(C{row}>0,C{row},0)"
-            else:
-                prev_row = row - 1
-                formula = f"=E{prev_row}+IF(D{row}>0,D{row},0)-IF(C{row}>0,C{row},0)"
-            
-            cell_e = ws.cell(row=row, column=5, value=formula)
-            cell_e.font = data_font
-            cell_e.alignment = right
-            cell_e.border = border
-            cell_e.number_format = money_fmt
-            
-            # F: 科目（シンプル表記）
-            cell_f = ws.cell(row=row, column=6, value=rec.get('subject', ''))
-            cell_f.font = Font(name='Arial', size=9,
-                               color='1F3864' if rec.get('subject') else 'BBBBBB')
-            cell_f.alignment = left
-            cell_f.border = border
-
-            # G: 2階層カテゴリ「🟢 収入  >  売上収入（馬主・育成）」
-            g_val = rec.get('g_label', '')
-            cell_g = ws.cell(row=row, column=7, value=g_val)
-            # 大分類ごとに文字色を変える
-            # ARGB形式（FF+RGBの8桁）で指定しないと透明になる
-            cat = rec.get('category', '')
-            if   '収入' in cat: g_color = 'FF375623'
-            elif '仕入' in cat: g_color = 'FF1F3864'
-            elif '外注' in cat: g_color = 'FF7F6000'
-            elif '人件' in cat: g_color = 'FFC55A11'
-            elif '金融' in cat: g_color = 'FFC00000'
-            elif '固定' in cat: g_color = 'FF4A148C'
-            elif '振替' in cat: g_color = 'FF666666'
-            else:               g_color = 'FF444444'
-            cell_g.font      = Font(name='Arial', size=10, color=g_color)
-            cell_g.alignment = left
-            cell_g.border    = border
-            
-            ws.row_dimensions[row].height = 15
-        
-        # ===== 合計行 =====
-        last_data_row = data_start_row + len(month_records) - 1
-        total_row = last_data_row + 1
-        
-        if month_records:
-            ws.merge_cells(f'A{total_row}:B{total_row}')
-            cell_t = ws.cell(row=total_row, column=1, value='合　計')
-            cell_t.font = Font(bold=True, name='Arial', size=10)
-            cell_t.fill = total_fill
-            cell_t.alignment = center
-            cell_t.border = border
-            
-            # 出金合計
-            ws.cell(row=total_row, column=3).value = f'=SUM(C{data_start_row}:C{last_data_row})'
-            ws.cell(row=total_row, column=3).number_format = money_fmt
-            ws.cell(row=total_row, column=3).font = Font(bold=True, name='Arial', size=10)
-            ws.cell(row=total_row, column=3).fill = total_fill
-            ws.cell(row=total_row, column=3).alignment = right
-            ws.cell(row=total_row, column=3).border = border
-            
-            # 入金合計
-            ws.cell(row=total_row, column=4).value = f'=SUM(D{data_start_row}:D{last_data_row})'
-            ws.cell(row=total_row, column=4).number_format = money_fmt
-            ws.cell(row=total_row, column=4).font = Font(bold=True, name='Arial', size=10)
-            ws.cell(row=total_row, column=4).fill = total_fill
-            ws.cell(row=total_row, column=4).alignment = right
-            ws.cell(row=total_row, column=4).border = border
-            
-            # 月末残高
-            ws.cell(row=total_row, column=5).value = f'=E{last_data_row}'
-            ws.cell(row=total_row, column=5).number_format = money_fmt
-            ws.cell(row=total_row, column=5).font = Font(bold=True, name='Arial', size=10, color='FFC00000')
-            ws.cell(row=total_row, column=5).fill = total_fill
-            ws.cell(row=total_row, column=5).alignment = right
-            ws.cell(row=total_row, column=5).border = border
-            
-            for c in [6, 7]:
-                ws.cell(row=total_row, column=c).fill = total_fill
-                ws.cell(row=total_row, column=c).border = border
-            
-            ws.row_dimensions[total_row].height = 18
-            
-            # 翌月の前月残高を記録（月末残高）
-            last_rec = month_records[-1]
-            next_month = month + 1 if month < 12 else 1
-            next_year  = year if month < 12 else year + 1
-            prev_balance[(next_year, next_month)] = last_rec['balance']
-        
-        # ===== 列幅設定（A〜G全列が1画面に収まるよう設定）=====
-        ws.column_dimensions['A'].width = 5
-        ws.column_dimensions['B'].width = 22
-        ws.column_dimensions['C'].width = 11
-        ws.column_dimensions['D'].width = 11
-        ws.column_dimensions['E'].width = 11
-        ws.column_dimensions['F'].width = 14
-        ws.column_dimensions['G'].width = 22
-
-        # ズーム80%に設定（全列が見えるよう）
-        ws.sheet_view.zoomScale = 80
-
-        # ヘッダー行を固定（スクロールしても1・2行目が常に見える）
-        ws.freeze_panes = 'A3'
-
-        # 印刷設定
-        ws.page_setup.orientation = 'landscape'
-        ws.page_setup.paperSize = 9  # A4
-        ws.print_title_rows = '1:2'
+    balances = opening_balances(by_month)  # 前月末残高
+    monthly_sheets = [month_sheet_name(i, y, m) for i,(y,m) in enumerate(sorted_months)]
+    summary_sheets = ['A. 📂カテゴリ別集計', 'B. 📊年間サマリー', 'C. 🏥経営健康診断']
+    styles = StyleRegistry(month_styles())  # 月別シートの書式番号は全シートで共有
+    wb.formula_results = {}  # シート名 -> {セル番地: 数式の計算結果}（save_workbook_bytes がセルに入れる）
+
+    if write_only:
+        # 書き込み専用は作った順に並ぶので、集計シートを別のワークブックで作ってから先に写す
+        scratch = openpyxl.Workbook()
+        scratch.remove(scratch.active)
+        build_summary_sheet(scratch, table)
+        build_category_sheet(scratch, table)
+        build_health_sheet(scratch, table)
+        for name in summary_sheets:
+            copy_sheet_write_only(scratch[name], wb)
+        for sheet_name, ym in zip(monthly_sheets, sorted_months):
+            wb.formula_results[sheet_name] = write_month_sheet(
+                wb.create_sheet(title=sheet_name), *ym, by_month[ym], balances[ym], styles, values_only)
+        if rule_stats is not None:
+            build_rule_stats_sheet(scratch, rule_stats)
+            copy_sheet_write_only(scratch.worksheets[-1], wb)
+        return wb
+
+    for sheet_name, ym in zip(monthly_sheets, sorted_months):
+        # D以降の記号は sorted_months のインデックスで決定
+        wb.formula_results[sheet_name] = write_month_sheet(
+            wb.create_sheet(title=sheet_name), *ym, by_month[ym], balances[ym], styles, values_only)
     
     # ===== 集計・診断シートを先頭に挿入（index指定で順番固定）=====
-    # 現在の月別シート数を取得してその前に挿入
-    num_monthly = len(sorted_months)
-
     # 月別シートをいったん退避して後ろに移動
     # openpyxlはmove_sheetで順序変更できる
-    build_summary_sheet(wb, records, by_month)   # 末尾に追加
-    build_category_sheet(wb, records)            # 末尾に追加
-    build_health_sheet(wb, records, by_month)    # 末尾に追加
+    build_summary_sheet(wb, table)    # 末尾に追加
+    build_category_sheet(wb, table)   # 末尾に追加
+    build_health_sheet(wb, table)     # 末尾に追加
 
     # シートを正しい順に並べ直す
     # 目標順: 📊年間サマリー, 📂カテゴリ別集計, 🏥経営健康診断, 月別(時系列)
-    summary_sheets  = ['A. 📂カテゴリ別集計', 'B. 📊年間サマリー', 'C. 🏥経営健康診断']
-    monthly_sheets  = [f"{chr(ord('D')+i)}. {y}年{MONTHS_JP[m]}" for i,(y,m) in enumerate(sorted_months)]
     desired_order   = summary_sheets + monthly_sheets
 
     for idx, name in enumerate(desired_order):
@@ -671,26 +2141,378 @@ def build_excel(records):
         if current_idx != idx:
             wb.move_sheet(name, offset=idx - current_idx)
 
+    # 仕訳ルール診断（指定時のみ・末尾）
+    if rule_stats is not None:
+        build_rule_stats_sheet(wb, rule_stats)
+
     return wb
 
-def build_summary_sheet(wb, records, by_month):
-    """年間サマリーシート"""
+# =====================================================
+# Excel のストリーミング出力（ブックを組み立てずに xlsx を少しずつ書き出す）
+# =====================================================
+
+# ストリーミング出力で一度に返すバイト数の目安
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', 64 * 1024))
+
+# 月別シートを並列に作る明細件数（PARSE_WORKERS が2以上のとき）
+PARALLEL_RENDER_MIN_ROWS = int(os.environ.get('PARALLEL_RENDER_MIN_ROWS', 50000))
+
+SHEET_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+
+# stream エンジンは openpyxl の内部（WorksheetWriter・WorkbookWriter・Manifest._write・Worksheet._id）と
+# zipfile の内部（_write_deflated）を使う。動作を確かめた版（requirements.txt と同じ範囲）でだけ使い、
+# それ以外では stream の指定も write_only で作る（resolve_engine）
+STREAM_OPENPYXL_VERSIONS = ('3.1.',)
+STREAM_ENGINE_AVAILABLE = (openpyxl.__version__.startswith(STREAM_OPENPYXL_VERSIONS)
+                           and WorksheetWriter is not None and hasattr(Manifest, '_write')
+                           and hasattr(zipfile.ZipInfo, 'FileHeader'))
+if not STREAM_ENGINE_AVAILABLE:
+    print(f"⚠️ openpyxl {openpyxl.__version__} では stream エンジンを使えないため write_only で作ります")
+
+# xlsx 内のファイルの日時とブックの作成・更新日時（固定。同じ内容なら同じバイト列の xlsx になるように）
+XLSX_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+XLSX_DOC_DATE = datetime(*XLSX_ZIP_DATE)
+
+def _zip_info(name):
+    info = zipfile.ZipInfo(name, XLSX_ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.external_attr = 0o600 << 16
+    return info
+
+# openpyxl が書く数式セル（計算結果の <v> は空）
+_EMPTY_FORMULA_CELL_RE = re.compile(rb'<c r="([A-Z]+[0-9]+)"([^>]*)><f>([^<]*)</f><v ?/>')
+
+def _copy_with_formula_results(src, dst, results):
+    """openpyxl が書いたシートXMLを写しながら、数式セルの空の <v> に results（{セル番地: 値}）の計算結果を入れる"""
+    def fill(m):
+        result = results.get(m.group(1).decode('ascii'))
+        if result is None:
+            return m.group(0)
+        return b'<c r="%s"%s><f>%s</f><v>%s</v>' % (m.group(1), m.group(2), m.group(3), str(result).encode('ascii'))
+
+    rest = b''
+    for block in iter(lambda: src.read(1024 * 1024), b''):
+        data = rest + block
+        end = data.rfind(b'</c>')  # セルの途中で切らない
+        if end < 0:
+            rest = data
+            continue
+        dst.write(_EMPTY_FORMULA_CELL_RE.sub(fill, data[:end + 4]))
+        rest = data[end + 4:]
+    dst.write(_EMPTY_FORMULA_CELL_RE.sub(fill, rest))
+
+class _FixedDateZipFile(zipfile.ZipFile):
+    """
+    ファイルの日時を XLSX_ZIP_DATE に固定する ZipFile（openpyxl の ExcelWriter にも渡せる）
+    formula_results: {xlsx 内のシートのパス: {セル番地: 値}}。そのシートの数式セルに計算結果を入れて書く
+    """
+    def __init__(self, *args, formula_results=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.formula_results = formula_results or {}
+
+    def writestr(self, zinfo_or_arcname, data, *args, **kwargs):
+        if not isinstance(zinfo_or_arcname, zipfile.ZipInfo):
+            zinfo_or_arcname = _zip_info(zinfo_or_arcname)
+        super().writestr(zinfo_or_arcname, data, *args, **kwargs)
+
+    def write(self, filename, arcname=None, *args, **kwargs):
+        # openpyxl はシートを一時ファイルに書いてから写す
+        zip64 = os.path.getsize(filename) >= zipfile.ZIP64_LIMIT
+        arcname = arcname or filename
+        with open(filename, 'rb') as src, self.open(_zip_info(arcname), 'w', force_zip64=zip64) as dst:
+            if arcname in self.formula_results:
+                _copy_with_formula_results(src, dst, self.formula_results[arcname])
+            else:
+                shutil.copyfileobj(src, dst, 1024 * 1024)
+
+def save_workbook_bytes(wb):
+    """
+    wb を xlsx のバイト列にする（日時を固定するので、同じ内容なら同じバイト列）
+    build_excel のブックは月別シートの数式に計算結果も入れる（stream と同じく、開いたときの全再計算は指定しない）
+    """
+    wb.properties.created = wb.properties.modified = XLSX_DOC_DATE
+    results = getattr(wb, 'formula_results', {})
+    if results:
+        wb.calculation.fullCalcOnLoad = False
+    # ExcelWriter はシートを並び順に sheet1.xml, sheet2.xml, ... として書く
+    paths = {f'xl/worksheets/sheet{i}.xml': results[ws.title]
+             for i, ws in enumerate(wb.worksheets, 1) if results.get(ws.title)}
+    buf = io.BytesIO()
+    ExcelWriter(wb, _FixedDateZipFile(buf, 'w', zipfile.ZIP_DEFLATED, allowZip64=True,
+                                      formula_results=paths)).save()
+    return buf.getvalue()
+
+class _ChunkSink:
+    """ZipFile の書き込み先（シークできないストリーム）。書かれたバイト列を溜めて take() で取り出す"""
+    def __init__(self):
+        self._chunks = []
+        self.size = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self.size += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        """溜まったバイト列（無ければ空）"""
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        self.size = 0
+        return data
+
+@lru_cache(maxsize=None)
+def month_sheet_xml_parts():
+    """月別シートのXMLのうち行データの前後（列幅・表示・印刷の設定は write_month_sheet と同じ）"""
+    cols = ''.join(f'<col min="{i}" max="{i}" width="{width}" customWidth="1"/>'
+                   for i, width in enumerate(MONTH_COLUMN_WIDTHS.values(), 1))
+    head = ('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            f'<worksheet xmlns="{SHEET_MAIN_NS}">'
+            '<sheetViews><sheetView zoomScale="80" workbookViewId="0">'
+            '<pane ySplit="2" topLeftCell="A3" activePane="bottomLeft" state="frozen"/>'
+            '<selection pane="bottomLeft" activeCell="A1" sqref="A1"/>'
+            '</sheetView></sheetViews>'
+            '<sheetFormatPr baseColWidth="8" defaultRowHeight="15"/>'
+            f'<cols>{cols}</cols><sheetData>')
+    tail = ('<pageMargins left="0.75" right="0.75" top="1" bottom="1" header="0.5" footer="0.5"/>'
+            '<pageSetup orientation="landscape" paperSize="9"/></worksheet>')
+    return head, tail
+
+def _cell_xml(ref, value, style_id):
+    """1セル分の SpreadsheetML（文字列はインライン文字列、'=' で始まる文字列は数式。Formula は計算結果も入れる）"""
+    if value is None or value == '':
+        return f'<c r="{ref}" s="{style_id}"/>'
+    if isinstance(value, Formula):
+        return f'<c r="{ref}" s="{style_id}"><f>{xml_escape(value[1:])}</f><v>{value.result}</v></c>'
+    if isinstance(value, str):
+        if value.startswith('='):
+            return f'<c r="{ref}" s="{style_id}"><f>{xml_escape(value[1:])}</f></c>'
+        space = ' xml:space="preserve"' if value.strip() != value else ''
+        return f'<c r="{ref}" s="{style_id}" t="inlineStr"><is><t{space}>{xml_escape(value)}</t></is></c>'
+    return f'<c r="{ref}" s="{style_id}"><v>{value}</v></c>'
+
+def check_sheet_text(table):
+    """
+    摘要・科目にワークシートに書けない文字（制御文字）があれば IllegalCharacterError
+    stream・分割出力はレスポンスを返し始めてから書くので、書き出しの途中で失敗しないように先に確かめる
+    """
+    records = table.records
+    if ILLEGAL_CHARACTERS_RE.search('\n'.join(rec['description'] for rec in records)):
+        for rec in records:
+            if ILLEGAL_CHARACTERS_RE.search(rec['description']):
+                raise IllegalCharacterError(
+                    f"{rec['date']:%Y/%m/%d} の明細「{ILLEGAL_CHARACTERS_RE.sub('?', rec['description'])}」"
+                    f"にExcelで使えない文字があります")
+    for label_id in set(table.label_ids):
+        if any(ILLEGAL_CHARACTERS_RE.search(text) for text in _LABELS[label_id]):
+            raise IllegalCharacterError(f"科目「{ILLEGAL_CHARACTERS_RE.sub('?', _LABELS[label_id][0])}」にExcelで使えない文字があります")
+
+def month_sheet_xml(title, year, month, month_records, prev_bal, style_ids, values_only=False):
+    """
+    月別シートのXMLを行ごとに返す（month_records はイテレータでもよい）
+    title: シート名（エラー表示用）/ style_ids: {書式名: セル書式番号}
+    数式には計算結果も入れる（Excel を開いたときの再計算や、計算しないビューアでの空白表示を避ける）
+    """
+    head, tail = month_sheet_xml_parts()
+    yield head
+    letters = [get_column_letter(col) for col in range(1, len(MONTH_HEADERS) + 1)]
+    last_row = 0
+    for row, height, cells in month_sheet_rows(year, month, month_records, prev_bal, values_only):
+        xml = ''.join(_cell_xml(f'{letters[col - 1]}{row}', value, style_ids[style])
+                      for col, value, style in cells)
+        if ILLEGAL_CHARACTERS_RE.search(xml):
+            raise IllegalCharacterError(f"{title} の {row} 行目にExcelで使えない文字があります")
+        yield f'<row r="{row}" ht="{height}" customHeight="1">{xml}</row>'
+        last_row = row
+    yield '</sheetData>'
+
+    # タイトル行と合計行（A:B）の結合
+    merges = ['A1:G1']
+    if last_row > 3:
+        merges.append(f'A{last_row}:B{last_row}')
+    yield f'<mergeCells count="{len(merges)}">'
+    yield ''.join(f'<mergeCell ref="{ref}"/>' for ref in merges)
+    yield '</mergeCells>' + tail
+
+def render_month_part(title, year, month, month_records, prev_bal, style_ids, values_only=False):
+    """
+    月別シート1枚のXMLを作り、zip と同じ形式（raw deflate）で圧縮して (CRC32, 元の長さ, 圧縮済みバイト列) を返す
+    プロセスプールの子プロセスから呼ばれる
+    """
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    crc = size = 0
+    out = []
+    for xml in month_sheet_xml(title, year, month, month_records, prev_bal, style_ids, values_only):
+        data = xml.encode('utf-8')
+        crc = zlib.crc32(data, crc)
+        size += len(data)
+        out.append(compressor.compress(data))
+    out.append(compressor.flush())
+    return crc, size, b''.join(out)
+
+def _write_deflated(archive, info, crc, size, data):
+    """圧縮済みのデータを zip の1ファイルとしてそのまま書く（ZipFile.open は圧縮前のデータしか受け付けないため）"""
+    info.compress_type = zipfile.ZIP_DEFLATED
+    info.CRC, info.file_size, info.compress_size = crc, size, len(data)
+    info.header_offset = archive.fp.tell()
+    archive.fp.write(info.FileHeader())
+    archive.fp.write(data)
+    archive.filelist.append(info)
+    archive.NameToInfo[info.filename] = info
+    archive.start_dir = archive.fp.tell()
+    archive._didModify = True
+
+def stream_excel(records, rule_version=None, rule_stats=None, parallel=None, values_only=False):
+    """
+    build_excel と同じ構成の xlsx をバイト列のかたまりで順に返す
+    月別シートは行ごとに zip へ書き、できた xlsx をメモリに溜めない（メモリに持つのは明細と集計シートだけ）。
+    集計シートは最後に作る（シートの並びは workbook.xml で決まるので、zip 内の順番は問わない）
+    records: 日付順の明細。/convert は解析済みの TransactionTable を渡す（そのまま集計に使う）。
+             リスト・イテレータなら月別シートを書きながら明細を集め、最後に TransactionTable を作る
+    parallel: True で月別シートをプロセスプールで並列に作る（前月繰越は先に全月分を求める）
+              None なら PARSE_WORKERS が2以上で明細が PARALLEL_RENDER_MIN_ROWS 件以上のとき並列
+    values_only: 月別シートの残高・合計を数式ではなく計算済みの数値で書く
+    """
+    if not STREAM_ENGINE_AVAILABLE:
+        raise RuntimeError(f"openpyxl {openpyxl.__version__} では stream エンジンを使えません")
+    table = records if isinstance(records, TransactionTable) else None
+    if parallel is None:
+        parallel = PARSE_WORKERS > 1 and table is not None and len(table.records) >= PARALLEL_RENDER_MIN_ROWS
+    sink = _ChunkSink()
+    archive = _FixedDateZipFile(sink, 'w', zipfile.ZIP_DEFLATED)
+    manifest = Manifest()
+
+    # 書式の一覧と小さいシートを持つブック（月別シートはタイトル・印刷設定だけ登録する）
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    if rule_version is not None:
+        wb.custom_doc_props.append(StringProperty(name='RuleVersion', value=rule_version))
+    summary_sheets = ['A. 📂カテゴリ別集計', 'B. 📊年間サマリー', 'C. 🏥経営健康診断']
+    style_ids = None
+    month_titles = []
+
+    def month_part(index, year, month):
+        """月別シートを登録し、その zip 内のファイル情報を返す"""
+        nonlocal style_ids
+        ws = wb.create_sheet(title=month_sheet_name(index, year, month))
+        ws.print_title_rows = '1:2'
+        ws._id = len(summary_sheets) + index + 1
+        month_titles.append(ws.title)
+        if style_ids is None:
+            # 月別シートの書式は決まった順に全部登録する（並列でも順に作っても styles.xml が同じになる）
+            styles = StyleRegistry(month_styles())
+            style_ids = {name: styles.style_id(ws, name) for name in styles.specs}
+        return ws.title, _zip_info(ws.path[1:])
+
+    months = groupby(table.records if table else records, key=lambda r: (r['year'], r['month']))
+    if parallel:
+        # ===== 月別シート（全月の前月繰越を先に求め、子プロセスで作って順に zip へ入れる）=====
+        by_month = {ym: list(month_iter) for ym, month_iter in months}
+        balances = opening_balances(by_month)
+        parts = [(ym, *month_part(index, *ym)) for index, ym in enumerate(by_month)]
+        jobs = [(title, *ym, by_month[ym], balances[ym], style_ids, values_only) for ym, title, _ in parts]
+        try:
+            pool = get_parse_pool()
+            futures = [pool.submit(render_month_part, *job) for job in jobs]
+        except BrokenProcessPool:
+            futures = [None] * len(jobs)
+        for job, future, (_, _, info) in zip(jobs, futures, parts):
+            try:
+                if future is None:
+                    raise BrokenProcessPool('プロセスプールが使えません')
+                part = future.result()
+            except BrokenProcessPool as e:
+                print(f"⚠️ 並列でのシート作成に失敗したため順に作ります: {e}")
+                _discard_parse_pool()
+                part = render_month_part(*job)
+            _write_deflated(archive, info, *part)
+            yield sink.take()
+        if table is None:
+            table = TransactionTable([rec for month_records in by_month.values() for rec in month_records])
+        del by_month, jobs
+    else:
+        # ===== 月別シート（届いた順に書き出す）=====
+        all_records = [] if table is None else None  # 渡された表があれば明細を集め直さない
+        carried = None  # (翌月の (年, 月), 月末残高)
+        for index, ((year, month), month_iter) in enumerate(months):
+            last = [None]  # この月の最後の明細（翌月の前月繰越）
+            first = next(month_iter)
+            prev_bal = carried[1] if carried and carried[0] == (year, month) else balance_before(first)
+
+            def collect(first=first, month_iter=month_iter, last=last):
+                for rec in chain([first], month_iter):
+                    if all_records is not None:
+                        all_records.append(rec)
+                    last[0] = rec
+                    yield rec
+
+            title, info = month_part(index, year, month)
+            with archive.open(info, 'w') as part:
+                for xml in month_sheet_xml(title, year, month, collect(), prev_bal, style_ids, values_only):
+                    part.write(xml.encode('utf-8'))
+                    if sink.size >= STREAM_CHUNK_SIZE:
+                        yield sink.take()
+
+            carried = ((year, month + 1) if month < 12 else (year + 1, 1), last[0]['balance'])
+
+    # ===== 集計・診断シート（月別シートの前に並べる）=====
+    if table is None:
+        table = TransactionTable(all_records)
+        all_records = None
+    build_summary_sheet(wb, table)
+    build_category_sheet(wb, table)
+    build_health_sheet(wb, table)
+    for idx, name in enumerate(summary_sheets):
+        wb.move_sheet(name, offset=idx - wb.sheetnames.index(name))
+    if rule_stats is not None:
+        build_rule_stats_sheet(wb, rule_stats)  # 末尾に追加
+
+    for idx, ws in enumerate(wb.worksheets, 1):
+        if ws.title not in month_titles:
+            ws._id = idx
+            writer = WorksheetWriter(ws, out=io.BytesIO())
+            writer.write()
+            archive.writestr(ws.path[1:], writer.read())
+        manifest.append(ws)
+
+    # ===== ブックの共通部分（書式・シート一覧・プロパティ）=====
+    wb.properties.created = wb.properties.modified = XLSX_DOC_DATE
+    wb.calculation.fullCalcOnLoad = False  # 数式には計算結果を入れてあるので、開くたびの全再計算は要らない
+    archive.writestr(ARC_APP, tostring(ExtendedProperties().to_tree()))
+    archive.writestr(ARC_CORE, tostring(wb.properties.to_tree()))
+    archive.writestr(ARC_THEME, theme_xml)
+    if len(wb.custom_doc_props):
+        archive.writestr(ARC_CUSTOM, tostring(wb.custom_doc_props.to_tree()))
+        manifest.Override.append(Override(PartName='/' + ARC_CUSTOM, ContentType=CPROPS_TYPE))
+    archive.writestr(ARC_STYLE, tostring(write_stylesheet(wb)))
+    writer = WorkbookWriter(wb)
+    archive.writestr(ARC_ROOT_RELS, writer.write_root_rels())
+    archive.writestr(ARC_WORKBOOK, writer.write())
+    archive.writestr(ARC_WORKBOOK_RELS, writer.write_rels())
+    manifest._write(archive, wb)
+    archive.close()
+    yield sink.take()
+
+def build_summary_sheet(wb, table):
+    """年間サマリーシート（table: TransactionTable）"""
+    month_totals = table.month_totals()
     ws = wb.create_sheet(title="B. 📊年間サマリー", index=0)
     
-    thin = Side(border_style='thin', color='CCCCCC')
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    center = Alignment(horizontal='center', vertical='center')
-    right  = Alignment(horizontal='right', vertical='center')
+    border = thin_border('CCCCCC')
+    center = cell_alignment(horizontal='center', vertical='center')
+    right  = cell_alignment(horizontal='right', vertical='center')
     
-    header_fill = PatternFill('solid', start_color='1F3864', end_color='1F3864')
-    alt_fill    = PatternFill('solid', start_color='F5F5F5', end_color='F5F5F5')
-    total_fill  = PatternFill('solid', start_color='FCE4D6', end_color='FCE4D6')
+    header_fill = solid_fill('1F3864')
+    alt_fill    = solid_fill('F5F5F5')
+    total_fill  = solid_fill('FCE4D6')
     
     # タイトル
     ws.merge_cells('A1:F1')
     ws['A1'] = '年間入出金サマリー'
-    ws['A1'].font = Font(bold=True, name='Arial', size=14, color='FFFFFFFF')
-    ws['A1'].fill = PatternFill('solid', start_color='1F3864', end_color='1F3864')
+    ws['A1'].font = cell_font(bold=True, name='Arial', size=14, color='FFFFFFFF')
+    ws['A1'].fill = solid_fill('1F3864')
     ws['A1'].alignment = center
     ws.row_dimensions[1].height = 24
     
@@ -698,13 +2520,13 @@ def build_summary_sheet(wb, records, by_month):
     headers = ['年月', '入金合計', '出金合計', '差引（純増減）', '月末残高', '入出金比率']
     for col, h in enumerate(headers, 1):
         cell = ws.cell(row=2, column=col, value=h)
-        cell.font = Font(bold=True, name='Arial', size=10, color='FFFFFFFF')
+        cell.font = cell_font(bold=True, name='Arial', size=10, color='FFFFFFFF')
         cell.fill = header_fill
         cell.alignment = center
         cell.border = border
     ws.row_dimensions[2].height = 18
     
-    sorted_months = sorted(by_month.keys())
+    sorted_months = list(month_totals)  # 年月順
     money_fmt = '#,##0'
     pct_fmt   = '0.0%'
     
@@ -712,19 +2534,19 @@ def build_summary_sheet(wb, records, by_month):
     
     for i, ym in enumerate(sorted_months):
         year, month = ym
-        recs = by_month[ym]
+        totals = month_totals.get(ym)
         row = i + 3
         
-        m_in  = sum(r['amount_in']  for r in recs)
-        m_out = sum(r['amount_out'] for r in recs)
-        m_bal = recs[-1]['balance'] if recs else 0
+        m_in  = totals['in']      if totals else 0
+        m_out = totals['out']     if totals else 0
+        m_bal = totals['balance'] if totals else 0
         m_diff = m_in - m_out
         m_ratio = m_in / m_out if m_out else None
         
         total_in  += m_in
         total_out += m_out
         
-        fill = alt_fill if i % 2 == 0 else PatternFill('solid', start_color='FFFFFF', end_color='FFFFFF')
+        fill = alt_fill if i % 2 == 0 else solid_fill('FFFFFF')
         
         ws.cell(row=row, column=1, value=f"{year}年{month}月").fill = fill
         ws.cell(row=row, column=2, value=m_in ).number_format = money_fmt
@@ -741,9 +2563,9 @@ def build_summary_sheet(wb, records, by_month):
         
         diff_cell = ws.cell(row=row, column=4)
         if m_diff < 0:
-            diff_cell.font = Font(name='Arial', size=10, color='FFC00000')
+            diff_cell.font = cell_font(name='Arial', size=10, color='FFC00000')
         else:
-            diff_cell.font = Font(name='Arial', size=10, color='FF375623')
+            diff_cell.font = cell_font(name='Arial', size=10, color='FF375623')
         
         for c in range(1, 7):
             cell = ws.cell(row=row, column=c)
@@ -764,7 +2586,7 @@ def build_summary_sheet(wb, records, by_month):
     for c in range(1, 7):
         cell = ws.cell(row=total_row, column=c)
         cell.fill = total_fill
-        cell.font = Font(bold=True, name='Arial', size=10)
+        cell.font = cell_font(bold=True, name='Arial', size=10)
         cell.border = border
         cell.alignment = right if c > 1 else center
     
@@ -774,38 +2596,26 @@ def build_summary_sheet(wb, records, by_month):
         ws.column_dimensions[col].width = 16
     ws.column_dimensions['F'].width = 12
 
-def build_category_sheet(wb, records):
-    """カテゴリ別集計シート"""
+def build_category_sheet(wb, table):
+    """カテゴリ別集計シート（table: TransactionTable）"""
     from collections import defaultdict
     ws = wb.create_sheet(title="A. 📂カテゴリ別集計")
 
-    thin = Side(border_style='thin', color='CCCCCC')
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    center = Alignment(horizontal='center', vertical='center')
-    right  = Alignment(horizontal='right',  vertical='center')
-    left   = Alignment(horizontal='left',   vertical='center')
+    border = thin_border('CCCCCC')
+    center = cell_alignment(horizontal='center', vertical='center')
+    right  = cell_alignment(horizontal='right',  vertical='center')
+    left   = cell_alignment(horizontal='left',   vertical='center')
     money_fmt = '#,##0'
 
     # カテゴリ別・科目別に集計
-    cat_data   = defaultdict(lambda: {'in': 0, 'out': 0, 'count': 0})
-    subj_data  = defaultdict(lambda: {'in': 0, 'out': 0, 'count': 0, 'category': ''})
-
-    for r in records:
-        cat  = r.get('category', '⚪ その他')
-        subj = r.get('subject',  '未分類')
-        cat_data[cat]['in']    += r['amount_in']
-        cat_data[cat]['out']   += r['amount_out']
-        cat_data[cat]['count'] += 1
-        subj_data[subj]['in']       += r['amount_in']
-        subj_data[subj]['out']      += r['amount_out']
-        subj_data[subj]['count']    += 1
-        subj_data[subj]['category'] = cat
+    cat_data   = table.category_totals()
+    subj_data  = table.subject_totals()
 
     # ===== タイトル =====
     ws.merge_cells('A1:F1')
     ws['A1'] = '📂 カテゴリ別 入出金集計'
-    ws['A1'].font  = Font(bold=True, name='Arial', size=13, color='FFFFFFFF')
-    ws['A1'].fill  = PatternFill('solid', start_color='203864', end_color='203864')
+    ws['A1'].font  = cell_font(bold=True, name='Arial', size=13, color='FFFFFFFF')
+    ws['A1'].fill  = solid_fill('203864')
     ws['A1'].alignment = center
     ws.row_dimensions[1].height = 24
 
@@ -840,16 +2650,16 @@ def build_category_sheet(wb, records):
     # ===== 大カテゴリ別サマリー表 =====
     ws.merge_cells(f'A{row}:F{row}')
     ws[f'A{row}'] = '■ 大カテゴリ別サマリー'
-    ws[f'A{row}'].font = Font(bold=True, name='Arial', size=11, color='FF1F3864')
-    ws[f'A{row}'].fill = PatternFill('solid', start_color='DEEAF1', end_color='DEEAF1')
+    ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=11, color='FF1F3864')
+    ws[f'A{row}'].fill = solid_fill('DEEAF1')
     ws.row_dimensions[row].height = 20
     row += 1
 
     hdr = ['カテゴリ', '入金合計', '出金合計', '差引', '件数', '']
     for c, h in enumerate(hdr, 1):
         cell = ws.cell(row=row, column=c, value=h)
-        cell.font  = Font(bold=True, name='Arial', size=10, color='FFFFFFFF')
-        cell.fill  = PatternFill('solid', start_color='1F3864', end_color='1F3864')
+        cell.font  = cell_font(bold=True, name='Arial', size=10, color='FFFFFFFF')
+        cell.fill  = solid_fill('1F3864')
         cell.alignment = center
         cell.border = border
     ws.row_dimensions[row].height = 18
@@ -861,7 +2671,7 @@ def build_category_sheet(wb, records):
         if not d:
             continue
         bg, fg = CAT_COLORS.get(cat, ('F5F5F5', '333333'))
-        fill = PatternFill('solid', start_color=bg, end_color=bg)
+        fill = solid_fill(bg)
         diff = d['in'] - d['out']
 
         vals = [cat, d['in'], d['out'], diff, d['count'], '']
@@ -872,24 +2682,24 @@ def build_category_sheet(wb, records):
             cell.alignment = right if c > 1 else left
             if c in (2,3,4):
                 cell.number_format = money_fmt
-                cell.font = Font(bold=True, name='Arial', size=10, color=fg)
+                cell.font = cell_font(bold=True, name='Arial', size=10, color=fg)
             elif c == 1:
-                cell.font = Font(bold=True, name='Arial', size=10, color=fg)
+                cell.font = cell_font(bold=True, name='Arial', size=10, color=fg)
             else:
-                cell.font = Font(name='Arial', size=10, color=fg)
+                cell.font = cell_font(name='Arial', size=10, color=fg)
             if c == 4 and diff < 0:
-                cell.font = Font(bold=True, name='Arial', size=10, color='FFC00000')
+                cell.font = cell_font(bold=True, name='Arial', size=10, color='FFC00000')
         total_in  += d['in']
         total_out += d['out']
         ws.row_dimensions[row].height = 17
         row += 1
 
     # 合計行
-    total_fill = PatternFill('solid', start_color='203864', end_color='203864')
+    total_fill = solid_fill('203864')
     for c, v in enumerate(['合　計', total_in, total_out, total_in-total_out, '', ''], 1):
         cell = ws.cell(row=row, column=c, value=v)
         cell.fill   = total_fill
-        cell.font   = Font(bold=True, name='Arial', size=11, color='FFFFFFFF')
+        cell.font   = cell_font(bold=True, name='Arial', size=11, color='FFFFFFFF')
         cell.border = border
         cell.alignment = right if c > 1 else center
         if c in (2,3,4):
@@ -900,16 +2710,16 @@ def build_category_sheet(wb, records):
     # ===== 科目別明細表 =====
     ws.merge_cells(f'A{row}:F{row}')
     ws[f'A{row}'] = '■ 科目別明細'
-    ws[f'A{row}'].font = Font(bold=True, name='Arial', size=11, color='FF1F3864')
-    ws[f'A{row}'].fill = PatternFill('solid', start_color='DEEAF1', end_color='DEEAF1')
+    ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=11, color='FF1F3864')
+    ws[f'A{row}'].fill = solid_fill('DEEAF1')
     ws.row_dimensions[row].height = 20
     row += 1
 
     hdr2 = ['カテゴリ', '科目', '入金合計', '出金合計', '差引', '件数']
     for c, h in enumerate(hdr2, 1):
         cell = ws.cell(row=row, column=c, value=h)
-        cell.font  = Font(bold=True, name='Arial', size=10, color='FFFFFFFF')
-        cell.fill  = PatternFill('solid', start_color='1F3864', end_color='1F3864')
+        cell.font  = cell_font(bold=True, name='Arial', size=10, color='FFFFFFFF')
+        cell.fill  = solid_fill('1F3864')
         cell.alignment = center
         cell.border = border
     ws.row_dimensions[row].height = 18
@@ -926,15 +2736,15 @@ def build_category_sheet(wb, records):
     for i, (cat, subj, d) in enumerate(sorted_subjs):
         bg, fg = CAT_COLORS.get(cat, ('F5F5F5', '333333'))
         if cat != prev_cat:
-            fill = PatternFill('solid', start_color=bg, end_color=bg)
+            fill = solid_fill(bg)
         else:
             # 同カテゴリは少し薄く
-            fill = PatternFill('solid', start_color='FAFAFA' if i%2==0 else 'F0F0F0', end_color='FAFAFA' if i%2==0 else 'F0F0F0')
+            fill = solid_fill('FAFAFA' if i%2==0 else 'F0F0F0')
         prev_cat = cat
 
         diff = d['in'] - d['out']
         # 科目に補助科目を付加して表示
-        subj_sample = next((r.get('sub_subject','') for r in records if r['subject']==subj and r.get('sub_subject','')), '')
+        subj_sample = d['sub_sample']
         subj_display2 = f"{subj}（{subj_sample}）" if subj_sample else subj
         vals = [cat, subj_display2, d['in'], d['out'], diff, d['count']]
         for c, v in enumerate(vals, 1):
@@ -944,11 +2754,11 @@ def build_category_sheet(wb, records):
             cell.alignment = right if c > 2 else left
             if c in (3,4,5):
                 cell.number_format = money_fmt
-                cell.font = Font(name='Arial', size=10)
+                cell.font = cell_font(name='Arial', size=10)
             else:
-                cell.font = Font(name='Arial', size=10)
+                cell.font = cell_font(name='Arial', size=10)
             if c == 5 and diff < 0:
-                cell.font = Font(name='Arial', size=10, color='FFC00000')
+                cell.font = cell_font(name='Arial', size=10, color='FFC00000')
         ws.row_dimensions[row].height = 16
         row += 1
 
@@ -960,17 +2770,15 @@ def build_category_sheet(wb, records):
     ws.column_dimensions['E'].width = 16
     ws.column_dimensions['F'].width = 8
 
-def build_health_sheet(wb, records, by_month):
-    """経営健康診断シート（動物病院モード × BizClinic参照ベンチマーク）"""
-    from collections import defaultdict
+def build_health_sheet(wb, table):
+    """経営健康診断シート（動物病院モード × BizClinic参照ベンチマーク。table: TransactionTable）"""
     ws = wb.create_sheet(title="C. 🏥経営健康診断")
 
-    thin   = Side(border_style='thin', color='CCCCCC')
-    border = Border(left=thin, right=thin, top=thin, bottom=thin)
-    center = Alignment(horizontal='center', vertical='center')
-    left   = Alignment(horizontal='left',   vertical='center')
-    right  = Alignment(horizontal='right',  vertical='center')
-    wrap   = Alignment(horizontal='left',   vertical='top', wrap_text=True)
+    border = thin_border('CCCCCC')
+    center = cell_alignment(horizontal='center', vertical='center')
+    left   = cell_alignment(horizontal='left',   vertical='center')
+    right  = cell_alignment(horizontal='right',  vertical='center')
+    wrap   = cell_alignment(horizontal='left',   vertical='top', wrap_text=True)
 
     # ===== 動物病院ベンチマーク（政府統計・BizClinic準拠） =====
     BM = {
@@ -998,19 +2806,14 @@ def build_health_sheet(wb, records, by_month):
         return (value - median) / median * 100 if median else 0
 
     # ===== KPI集計 =====
-    total_in  = sum(r['amount_in']  for r in records)
-    total_out = sum(r['amount_out'] for r in records)
+    records   = table.records
+    month_totals = table.month_totals()
+    total_in  = table.total_in
+    total_out = table.total_out
     net       = total_in - total_out
-    months_count = len(by_month)
+    months_count = len(month_totals)
 
-    by_subj = defaultdict(int)
-    top_items_by_subj = defaultdict(list)  # 科目→[(金額,説明)]
-    for r in records:
-        if r['amount_out']:
-            s = r.get('subject','')
-            amt = r['amount_out']
-            by_subj[s] += amt
-            top_items_by_subj[s].append((amt, r['description'][:20]))
+    by_subj = {s: d['out'] for s, d in table.subject_totals().items() if d['out']}
 
     sales    = total_in
     cogs     = by_subj.get('仕入', 0)
@@ -1035,19 +2838,20 @@ def build_health_sheet(wb, records, by_month):
 
     # 月別収支
     monthly_data = []
-    for ym in sorted(by_month.keys()):
-        recs = by_month[ym]
-        m_in  = sum(r['amount_in']  for r in recs)
-        m_out = sum(r['amount_out'] for r in recs)
+    for ym, totals in month_totals.items():
+        m_in  = totals['in']
+        m_out = totals['out']
         monthly_data.append({'ym': ym, 'in': m_in, 'out': m_out, 'diff': m_in - m_out})
     red_months = sum(1 for m in monthly_data if m['diff'] < 0)
     avg_in  = total_in  / months_count if months_count else 0
     avg_out = total_out / months_count if months_count else 0
 
-    # 科目ごとのTop取引先
+    # 科目ごとのTop取引先（その科目のラベルの出金行だけを見る）
     def top_vendors(subj_key, n=3):
-        items = sorted(top_items_by_subj.get(subj_key, []), reverse=True)[:n]
-        return items
+        label_ids = {i for i, label in enumerate(_LABELS) if label[0] == subj_key}
+        rows = (i for i, (label_id, out) in enumerate(zip(table.label_ids, table.amount_out))
+                if out and label_id in label_ids)
+        return heapq.nlargest(n, ((table.amount_out[i], records[i]['description'][:20]) for i in rows))
 
     # 主因分析（BizClinic cause_analysis参照）
     scores = {
@@ -1060,7 +2864,7 @@ def build_health_sheet(wb, records, by_month):
     # ===== スタイル定義 =====
     def fill(hex6):
         c = hex6 if len(hex6) == 8 else 'FF' + hex6
-        return PatternFill('solid', start_color=c, end_color=c)
+        return solid_fill(c)
     DARK_GREEN = '1B4F2A';  LIGHT_GREEN = 'E8F5E9'
     YELLOW_BG  = 'FFFFF9C4'; RED_BG     = 'FFEBEE'
     GRAY_BG    = 'F8F8F8';   WHITE      = 'FFFFFF'
@@ -1068,7 +2872,7 @@ def build_health_sheet(wb, records, by_month):
     def write_section(row, title, bg=DARK_GREEN, fg='FFFFFFFF'):
         ws.merge_cells(f'A{row}:I{row}')
         ws[f'A{row}'] = title
-        ws[f'A{row}'].font = Font(bold=True, name='Arial', size=11, color=fg)
+        ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=11, color=fg)
         ws[f'A{row}'].fill = fill(bg)
         ws[f'A{row}'].alignment = left
         ws.row_dimensions[row].height = 22
@@ -1076,7 +2880,7 @@ def build_health_sheet(wb, records, by_month):
     def write_table_header(row, headers, col_widths=None):
         for c, h in enumerate(headers, 1):
             cell = ws.cell(row=row, column=c, value=h)
-            cell.font  = Font(bold=True, name='Arial', size=9, color='FFFFFFFF')
+            cell.font  = cell_font(bold=True, name='Arial', size=9, color='FFFFFFFF')
             cell.fill  = fill(DARK_GREEN)
             cell.alignment = center
             cell.border = border
@@ -1088,15 +2892,15 @@ def build_health_sheet(wb, records, by_month):
         dev = deviation_pct(actual, median)
 
         cells_data = [
-            (1, label,       left,   bg, Font(name='Arial', size=10)),
-            (2, actual_str,  right,  bg, Font(bold=True, name='Arial', size=10)),
-            (3, f'{median:.1%}',  center, bg, Font(name='Arial', size=9, color='FF888888')),
-            (4, f'{q1:.1%}',     center, bg, Font(name='Arial', size=9, color='FF4CAF50')),
-            (5, f'{q3:.1%}',     center, bg, Font(name='Arial', size=9, color='FFEF5350')),
-            (6, f'{dev:+.1f}%',  center, bg, Font(name='Arial', size=9,
+            (1, label,       left,   bg, cell_font(name='Arial', size=10)),
+            (2, actual_str,  right,  bg, cell_font(bold=True, name='Arial', size=10)),
+            (3, f'{median:.1%}',  center, bg, cell_font(name='Arial', size=9, color='FF888888')),
+            (4, f'{q1:.1%}',     center, bg, cell_font(name='Arial', size=9, color='FF4CAF50')),
+            (5, f'{q3:.1%}',     center, bg, cell_font(name='Arial', size=9, color='FFEF5350')),
+            (6, f'{dev:+.1f}%',  center, bg, cell_font(name='Arial', size=9,
                                     color='FF4CAF50' if dev < 0 and actual < median else
                                            'FFEF5350' if dev > 5 else 'FF333333')),
-            (7, rank_label,  center, bg, Font(bold=True, name='Arial', size=9, color=rank_color)),
+            (7, rank_label,  center, bg, cell_font(bold=True, name='Arial', size=9, color=rank_color)),
         ]
         for c, val, aln, bg_col, fnt in cells_data:
             cell = ws.cell(row=row, column=c, value=val)
@@ -1107,7 +2911,7 @@ def build_health_sheet(wb, records, by_month):
         ws.merge_cells(f'H{row}:I{row}')
         adv_cell = ws.cell(row=row, column=8, value=advice)
         adv_bg = 'E8F5E9' if 'top' in rank_key or 'above' in rank_key else 'FFF9C4' if 'below' in rank_key else 'FFEBEE'
-        adv_cell.font = Font(name='Arial', size=9,
+        adv_cell.font = cell_font(name='Arial', size=9,
                              color='FF1B4F2A' if 'top' in rank_key or 'above' in rank_key else
                                     'FF7F6000' if 'below' in rank_key else 'FFC00000')
         adv_cell.fill = fill(adv_bg)
@@ -1119,15 +2923,15 @@ def build_health_sheet(wb, records, by_month):
     # ===== ヘッダー =====
     ws.merge_cells('A1:I1')
     ws['A1'] = 'E-MEITA仕訳Excel　🏥 経営健康診断レポート（動物病院モード）'
-    ws['A1'].font  = Font(bold=True, name='Arial', size=14, color='FFFFFFFF')
+    ws['A1'].font  = cell_font(bold=True, name='Arial', size=14, color='FFFFFFFF')
     ws['A1'].fill  = fill(DARK_GREEN)
     ws['A1'].alignment = center
     ws.row_dimensions[1].height = 30
 
     ws.merge_cells('A2:I2')
     period = f"{records[0]['date'].strftime('%Y/%m/%d')} ～ {records[-1]['date'].strftime('%Y/%m/%d')}" if records else 'N/A'
-    ws['A2'] = f'生成: {datetime.now().strftime("%Y/%m/%d %H:%M")}  |  対象: {period}  |  {months_count}ヶ月  |  ベンチマーク: 政府統計（財務省・中小企業庁 2023年度）'
-    ws['A2'].font = Font(name='Arial', size=8, color='FF888888')
+    ws['A2'] = f'対象: {period}  |  {months_count}ヶ月  |  ベンチマーク: 政府統計（財務省・中小企業庁 2023年度）'
+    ws['A2'].font = cell_font(name='Arial', size=8, color='FF888888')
     ws['A2'].alignment = left
 
     # ===== セクション1: 動物病院KPI比較 =====
@@ -1205,7 +3009,7 @@ def build_health_sheet(wb, records, by_month):
     fl_msg = (f'{fl_status}  FL比率: {fl_ratio:.1%}  （仕入率{cogs_r:.1%} ＋ 人件費率{labor_r:.1%}）   '
               f'{"▶ 適正範囲（61%以内）" if fl_ratio <= 0.61 else f"▶ {heavier}が重い。まずこちらから改善してください。"}')
     ws[f'A{row}'] = fl_msg
-    ws[f'A{row}'].font = Font(bold=True, name='Arial', size=11, color=fl_color)
+    ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=11, color=fl_color)
     ws[f'A{row}'].fill = fill(fl_bg)
     ws[f'A{row}'].alignment = left
     ws[f'A{row}'].border = border
@@ -1240,8 +3044,8 @@ def build_health_sheet(wb, records, by_month):
             cell = ws.cell(row=row, column=c, value=v)
             cell.fill = fill(bg_row); cell.border = border; cell.alignment = aln
             if fmt: cell.number_format = fmt
-            if c == 4: cell.font = Font(name='Arial', size=10, color='FFC00000' if md['diff']<0 else 'FF333333')
-            if c == 5: cell.font = Font(bold=True, name='Arial', size=9, color=jc)
+            if c == 4: cell.font = cell_font(name='Arial', size=10, color='FFC00000' if md['diff']<0 else 'FF333333')
+            if c == 5: cell.font = cell_font(bold=True, name='Arial', size=9, color=jc)
         for c in [7, 8, 9]:
             ws.cell(row=row, column=c).fill = fill(bg_row); ws.cell(row=row, column=c).border = border
         ws.row_dimensions[row].height = 16
@@ -1294,7 +3098,7 @@ def build_health_sheet(wb, records, by_month):
 
     ws.merge_cells(f'A{row}:I{row}')
     ws[f'A{row}'] = f'{se}  総合スコア：{score}点 / 100点  ({sl})   主因: {primary_cause or "良好・問題なし"}'
-    ws[f'A{row}'].font = Font(bold=True, name='Arial', size=14, color=sc_col)
+    ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=14, color=sc_col)
     ws[f'A{row}'].fill = fill('E8F5E9' if score >= 80 else 'FFF9C4' if score >= 60 else 'FFEBEE')
     ws[f'A{row}'].alignment = center
     for c in range(1, 10):
@@ -1308,7 +3112,7 @@ def build_health_sheet(wb, records, by_month):
         tc_a = 'FF1B4F2A' if emoji_a == '✅' else 'FF7F6000' if emoji_a == '⚠️' else 'FFC00000'
         ws.merge_cells(f'A{row}:I{row}')
         ws[f'A{row}'] = f'  {emoji_a}  {text_a}'
-        ws[f'A{row}'].font = Font(name='Arial', size=10, color=tc_a)
+        ws[f'A{row}'].font = cell_font(name='Arial', size=10, color=tc_a)
         ws[f'A{row}'].fill = fill(bg_a)
         ws[f'A{row}'].alignment = wrap
         ws[f'A{row}'].border = border
@@ -1325,6 +3129,306 @@ def build_health_sheet(wb, records, by_month):
     ws.sheet_view.zoomScale = 90
     ws.freeze_panes = 'A3'
 
+def build_rule_stats_sheet(wb, report, top=200):
+    """仕訳ルール診断シート（キーワード別ヒット数・フォールバック摘要）"""
+    ws = wb.create_sheet(title="🔍仕訳ルール診断")
+
+    border = thin_border('CCCCCC')
+    center = cell_alignment(horizontal='center', vertical='center')
+    right  = cell_alignment(horizontal='right',  vertical='center')
+    left   = cell_alignment(horizontal='left',   vertical='center')
+    header_fill = solid_fill('1F3864')
+    section_fill = solid_fill('DEEAF1')
+    dead_fill   = solid_fill('FFEBEE')
+    money_fmt = '#,##0'
+
+    ws.merge_cells('A1:E1')
+    ws['A1'] = f"🔍 仕訳ルール診断　（辞書 v{report['rule_version']} ／ {report['rows']:,}行）"
+    ws['A1'].font = cell_font(bold=True, name='Arial', size=13, color='FFFFFFFF')
+    ws['A1'].fill = header_fill
+    ws['A1'].alignment = center
+    ws.row_dimensions[1].height = 24
+    row = 3
+
+    def section(title):
+        nonlocal row
+        ws.merge_cells(f'A{row}:E{row}')
+        ws[f'A{row}'] = title
+        ws[f'A{row}'].font = cell_font(bold=True, name='Arial', size=11, color='FF1F3864')
+        ws[f'A{row}'].fill = section_fill
+        ws.row_dimensions[row].height = 20
+        row += 1
+
+    def table(headers, rows, fills=None):
+        nonlocal row
+        for c, h in enumerate(headers, 1):
+            cell = ws.cell(row=row, column=c, value=h)
+            cell.font = cell_font(bold=True, name='Arial', size=10, color='FFFFFFFF')
+            cell.fill = header_fill
+            cell.alignment = center
+            cell.border = border
+        row += 1
+        for i, vals in enumerate(rows):
+            for c, v in enumerate(vals, 1):
+                cell = ws.cell(row=row, column=c, value=v)
+                cell.font = cell_font(name='Arial', size=10)
+                cell.border = border
+                if isinstance(v, (int, float)):
+                    cell.alignment = right
+                    cell.number_format = money_fmt
+                else:
+                    cell.alignment = left
+                if fills and fills[i]:
+                    cell.fill = fills[i]
+            row += 1
+        row += 1
+
+    # ステップ別件数
+    section('■ 判定ステップ別件数')
+    table(['ステップ', '件数', '構成比', '', ''],
+          [[label, n, f"{n / report['rows']:.1%}" if report['rows'] else '', '', '']
+           for label, n in sorted(report['steps'].items(), key=lambda x: -x[1])])
+
+    # キーワード別ヒット数（0件は赤＝不要ルール候補）
+    section('■ キーワード別ヒット数（0件は不要ルール候補）')
+    rules = report['rules']
+    table(['STEP', 'キーワード（正規形）', '科目', '補助科目', 'ヒット数'],
+          [[r['step'], r['keyword'], r['subject'], r['sub_subject'], r['hits']] for r in rules],
+          [None if r['hits'] else dead_fill for r in rules])
+
+    # フォールバック摘要（頻度順）
+    for key, title in (('out', '■ STEP2フォールバック（キーワードなし → 人件費/スタッフ）'),
+                       ('in',  '■ STEP3フォールバック（補助科目なしの売上）'),
+                       ('similar', '■ 類似摘要から推定（キーワードなし → 最も近い既知の支払先）')):
+        section(title)
+        table(['摘要', '件数', '', '', ''],
+              [[f['description'], f['count'], '', '', ''] for f in report['fallback'][key][:top]])
+
+    ws.column_dimensions['A'].width = 36
+    ws.column_dimensions['B'].width = 30
+    ws.column_dimensions['C'].width = 14
+    ws.column_dimensions['D'].width = 16
+    ws.column_dimensions['E'].width = 10
+    ws.freeze_panes = 'A2'
+
+# =====================================================
+# 分割出力（年度別・月別のブックを1つのZIPにまとめる）
+# =====================================================
+FISCAL_YEAR_START = int(os.environ.get('FISCAL_YEAR_START', 1))  # 年度の始まりの月（1 なら暦年）
+
+def resolve_engine(engine, record_count):
+    """
+    Excel生成エンジンの省略時（'' / auto）は件数で選ぶ（record_count が None なら auto のまま）
+    stream を使えない openpyxl の版（STREAM_ENGINE_AVAILABLE）では write_only にする
+    """
+    if engine in ('', 'auto'):
+        if record_count is None:
+            return 'auto'
+        engine = 'stream' if record_count > WRITE_ONLY_THRESHOLD else 'standard'
+    if engine == 'stream' and not STREAM_ENGINE_AVAILABLE:
+        return 'write_only'
+    return engine
+
+def split_records(records, by='year', start_month=None):
+    """
+    日付順の明細を年度別（by='year'）または月別（by='month'）に分け、[(ラベル, 明細のリスト)] を返す
+    年度は start_month 月（既定 FISCAL_YEAR_START）始まりで、始まる年で呼ぶ（4月始まりなら 2024年4月〜2025年3月 が 2024年度）
+    """
+    if start_month is None:
+        start_month = FISCAL_YEAR_START
+
+    def period(rec):
+        if by == 'month':
+            return rec['year'], rec['month']
+        return rec['year'] - (rec['month'] < start_month), None
+
+    parts = []
+    for (year, month), part in groupby(records, key=period):
+        if month is not None:
+            label = f"{year}年{month:02d}月"
+        elif start_month == 1:
+            label = f"{year}年"
+        else:
+            label = f"{year}年度"
+        parts.append((label, list(part)))
+    return parts
+
+def render_split_part(records, rule_version=None, engine='auto', values_only=False):
+    """
+    分けた明細1つ分のブック（集計・診断シート付き）を作り、xlsx のバイト列を返す
+    プロセスプールの子プロセスから呼ばれる。engine は /convert と同じ（auto はこの部分の件数で選ぶ）
+    """
+    engine = resolve_engine(engine, len(records))
+    if engine == 'stream':
+        return b''.join(stream_excel(records, rule_version, parallel=False, values_only=values_only))
+    wb = build_excel(records, rule_version, write_only=engine == 'write_only', values_only=values_only)
+    return save_workbook_bytes(wb)
+
+def render_rule_stats_book(rule_stats, rule_version=None):
+    """仕訳ルール診断シートだけのブックを作り、xlsx のバイト列を返す"""
+    wb = openpyxl.Workbook()
+    wb.remove(wb.active)
+    if rule_version is not None:
+        wb.custom_doc_props.append(StringProperty(name='RuleVersion', value=rule_version))
+    build_rule_stats_sheet(wb, rule_stats)
+    return save_workbook_bytes(wb)
+
+def split_excel(parts, rule_version=None, rule_stats=None, engine='auto', values_only=False, prefix='E-MEITA仕訳Excel'):
+    """
+    split_records の部分ごとに1冊ずつ作り、{prefix}_{ラベル}.xlsx を並べた ZIP をバイト列のかたまりで順に返す
+    部分が2つ以上で PARSE_WORKERS が2以上なら子プロセスで並列に作り、できた順ではなく部分の順に書く
+    rule_stats（アップロード全体の RuleStats.report()）は各冊には付けず、{prefix}_仕訳ルール診断.xlsx として最後に1冊だけ入れる
+    xlsx はもともと圧縮されているので ZIP には無圧縮で入れる
+    """
+    sink = _ChunkSink()
+    archive = _FixedDateZipFile(sink, 'w', zipfile.ZIP_STORED)
+    jobs = [(records, rule_version, engine, values_only) for _, records in parts]
+    futures = [None] * len(jobs)
+    if len(jobs) > 1 and PARSE_WORKERS > 1:
+        try:
+            pool = get_parse_pool()
+            futures = [pool.submit(render_split_part, *job) for job in jobs]
+        except BrokenProcessPool:
+            futures = [None] * len(jobs)
+    for (label, _), job, future in zip(parts, jobs, futures):
+        data = None
+        if future is not None:
+            try:
+                data = future.result()
+            except BrokenProcessPool as e:
+                print(f"⚠️ 並列でのブック作成に失敗したため順に作ります: {e}")
+                _discard_parse_pool()
+        if data is None:
+            data = render_split_part(*job)
+        archive.writestr(f"{prefix}_{label}.xlsx", data, zipfile.ZIP_STORED)
+        yield sink.take()
+    if rule_stats is not None:
+        archive.writestr(f"{prefix}_仕訳ルール診断.xlsx", render_rule_stats_book(rule_stats, rule_version),
+                         zipfile.ZIP_STORED)
+    archive.close()
+    yield sink.take()
+
+# =====================================================
+# 変換結果のキャッシュ（同じCSVの再アップロードは解析・生成をせずに返す）
+# =====================================================
+EXCEL_CACHE_DIR = os.environ.get(
+    'EXCEL_CACHE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'excel_cache'))
+EXCEL_CACHE_MAX_MB = int(os.environ.get('EXCEL_CACHE_MAX_MB', 500))  # 0 でキャッシュしない
+
+# このプログラム自体の版（出力の作りが変わったら古いキャッシュを使わない）
+with open(__file__, 'rb') as _f:
+    APP_REVISION = hashlib.sha1(_f.read()).hexdigest()[:12]
+
+class WorkbookCache:
+    """
+    生成したExcelのディスクキャッシュ
+    キーはアップロード内容・仕訳辞書のバージョン・上書き表・出力オプションのハッシュ（同じキーなら同じバイト列）
+    {キー}.xlsx とレスポンスヘッダーの {キー}.json を置き、合計が上限を超えたら使われていない順に消す
+    （分割出力の ZIP も {キー}.xlsx の名前で置く）
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        if self.enabled:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(uploads, *options):
+        """uploads: (ファイル名, バイト列 or バイナリストリーム) のリスト（ファイル名は出力に関係しないので含めない）"""
+        h = hashlib.sha256()
+        for option in (APP_REVISION,) + options:
+            h.update(f"{option}\x1f".encode('utf-8'))
+        for _, data in uploads:
+            h.update(b'\x1e')
+            if isinstance(data, (bytes, bytearray)):
+                h.update(data)
+                continue
+            for block in iter(lambda: data.read(1024 * 1024), b''):
+                h.update(block)
+            data.seek(0)
+        return h.hexdigest()[:32]
+
+    def _path(self, key, ext):
+        return os.path.join(self.directory, key + ext)
+
+    def get(self, key):
+        """(開いた xlsx ファイル, レスポンスヘッダー)。無ければ None"""
+        try:
+            f = open(self._path(key, '.xlsx'), 'rb')
+        except OSError:
+            return None
+        try:
+            with open(self._path(key, '.json'), encoding='utf-8') as meta:
+                headers = json.load(meta)
+            os.utime(f.name)  # 更新日時 = 最後に使われた日時（消す順番に使う）
+        except (OSError, ValueError):
+            f.close()
+            return None
+        return f, headers
+
+    def put(self, key, data, headers):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            self._commit(key, tmp, headers)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def tee(self, key, chunks, headers):
+        """chunks をそのまま返しながらキャッシュにも書く（最後まで返せたときだけ登録する）"""
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+            self._commit(key, tmp, headers)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+
+    def _commit(self, key, tmp, headers):
+        # ヘッダーを先に置き、xlsx の置き換えで登録完了とする（get は xlsx があるものだけ返す）
+        fd, meta_tmp = tempfile.mkstemp(dir=self.directory, suffix='.part')
+        with os.fdopen(fd, 'w', encoding='utf-8') as meta:
+            json.dump(headers, meta, ensure_ascii=False)
+        os.replace(meta_tmp, self._path(key, '.json'))
+        os.replace(tmp, self._path(key, '.xlsx'))
+        self.evict()
+
+    def evict(self):
+        """合計サイズが上限以下になるまで、最後に使われたのが古いものから消す"""
+        with self._lock:
+            entries = []
+            for name in os.listdir(self.directory):
+                if not name.endswith('.xlsx'):
+                    continue
+                try:
+                    st = os.stat(os.path.join(self.directory, name))
+                except OSError:
+                    continue
+                entries.append((st.st_mtime_ns, st.st_size, name[:-len('.xlsx')]))
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                for ext in ('.xlsx', '.json'):
+                    try:
+                        os.remove(self._path(key, ext))
+                    except OSError:
+                        pass
+                total -= size
+
+EXCEL_CACHE = WorkbookCache(EXCEL_CACHE_DIR, EXCEL_CACHE_MAX_MB * 1024 * 1024)
+
 # =====================================================
 # Flask ルーティング
 # =====================================================
@@ -1414,7 +3518,7 @@ def parse_pl_text(text: str) -> dict:
 
 
 def evaluate_pl(pl_data: dict, bank_records: list = None) -> dict:
-    """P&Lデータを評価してレポートを生成する"""
+    """P&Lデータを評価してレポートを生成する（bank_records は明細リストまたは TransactionTable）"""
     revenue = pl_data['revenue']
     items   = pl_data['items']
     
@@ -1486,19 +3590,20 @@ def evaluate_pl(pl_data: dict, bank_records: list = None) -> dict:
         m = _re.match(r'(\d{4})年(\d{1,2})月', period)
         if m:
             yr, mo = int(m.group(1)), int(m.group(2))
-            month_recs = [r for r in bank_records if r['year'] == yr and r['month'] == mo]
-            if month_recs:
-                bank_in  = sum(r['amount_in']  for r in month_recs)
-                bank_out = sum(r['amount_out'] for r in month_recs)
+            table = bank_records if isinstance(bank_records, TransactionTable) else TransactionTable(bank_records)
+            month_totals = table.month(yr, mo)
+            if month_totals:
+                bank_in  = month_totals['in']
+                bank_out = month_totals['out']
                 bank_net = bank_in - bank_out
-                end_bal  = month_recs[-1]['balance']
+                end_bal  = month_totals['balance']
                 diff_rev = abs(revenue - bank_in)
                 match_pct = max(0, 1 - diff_rev / max(revenue, 1)) * 100
                 bank_summary = {
                     'bank_in': bank_in, 'bank_out': bank_out,
                     'bank_net': bank_net, 'end_balance': end_bal,
                     'diff_from_pl': diff_rev, 'match_pct': match_pct,
-                    'count': len(month_recs),
+                    'count': month_totals['count'],
                 }
     
     # ─── 改善アドバイス ───────────────────────────────────────────
@@ -2261,10 +4366,10 @@ HTML = r'''<!DOCTYPE html>
 
     <div class="section-title"><svg class="section-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M14 2H6a2 2 0 0 0-2 2v16a2 2 0 0 0 2 2h12a2 2 0 0 0 2-2V8z"></path><polyline points="14 2 14 8 20 8"></polyline></svg> 銀行明細CSVをアップロード</div>
     <div class="upload-area" id="dropZone">
-      <input type="file" id="fileInput" accept=".csv">
+      <input type="file" id="fileInput" accept=".csv,.zip" multiple>
       <svg class="upload-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M21 15v4a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2v-4"></path><polyline points="17 8 12 3 7 8"></polyline><line x1="12" y1="3" x2="12" y2="15"></line></svg>
       <div class="upload-text">CSVファイルをここにドロップ</div>
-      <div class="upload-sub">またはクリックして選択（Shift-JIS/UTF-8 自動判定）</div>
+      <div class="upload-sub">またはクリックして選択（複数ファイル・ZIP可／Shift-JIS/UTF-8 自動判定）</div>
     </div>
     <div class="file-info" id="fileInfo"><svg class="check-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="3" stroke-linecap="round" stroke-linejoin="round"><polyline points="20 6 9 17 4 12"></polyline></svg><span id="fileName"></span></div>
     <button class="btn" id="convertBtn" disabled onclick="convert()"><svg class="btn-icon" viewBox="0 0 24 24" fill="none" stroke="currentColor" stroke-width="2" stroke-linecap="round" stroke-linejoin="round"><path d="M22 2L11 13"></path><path d="M22 2l-7 20-4-9-9-4 20-7z"></path></svg> Excelを生成する</button>
@@ -2399,17 +4504,20 @@ const dropZone   = document.getElementById('dropZone');
 const fileInfo   = document.getElementById('fileInfo');
 const fileName   = document.getElementById('fileName');
 const convertBtn = document.getElementById('convertBtn');
-let selectedFile = null;
+let selectedFiles = [];
 
-fileInput.addEventListener('change', e => handleFile(e.target.files[0]));
+fileInput.addEventListener('change', e => handleFile(e.target.files));
 dropZone.addEventListener('dragover', e => { e.preventDefault(); dropZone.classList.add('drag'); });
 dropZone.addEventListener('dragleave', () => dropZone.classList.remove('drag'));
-dropZone.addEventListener('drop', e => { e.preventDefault(); dropZone.classList.remove('drag'); handleFile(e.dataTransfer.files[0]); });
-
-function handleFile(file) {
-  if (!file) return;
-  selectedFile = file;
-  fileName.textContent = `${file.name}（${(file.size/1024).toFixed(0)} KB）`;
+dropZone.addEventListener('drop', e => { e.preventDefault(); dropZone.classList.remove('drag'); handleFile(e.dataTransfer.files); });
+
+function handleFile(files) {
+  if (!files || !files.length) return;
+  selectedFiles = Array.from(files);
+  const size = selectedFiles.reduce((s, f) => s + f.size, 0);
+  fileName.textContent = selectedFiles.length === 1
+    ? `${selectedFiles[0].name}（${(size/1024).toFixed(0)} KB）`
+    : `${selectedFiles.length}ファイル（${(size/1024).toFixed(0)} KB）`;
   fileInfo.classList.add('show');
   convertBtn.disabled = false;
   document.getElementById('result').classList.remove('show');
@@ -2417,7 +4525,7 @@ function handleFile(file) {
 }
 
 async function convert() {
-  if (!selectedFile) return;
+  if (!selectedFiles.length) return;
   convertBtn.disabled = true;
   const progress = document.getElementById('progress');
   const bar = document.getElementById('progressBar');
@@ -2429,7 +4537,7 @@ async function convert() {
     const msgs = ['📥 CSV読み込み中...','📊 月別整理中...','📋 シート生成中...','🏥 診断中...'];
     document.getElementById('status').textContent = msgs[Math.floor(pct/25)] || msgs[3];
   }, 200);
-  const fd = new FormData(); fd.append('file', selectedFile);
+  const fd = new FormData(); selectedFiles.forEach(f => fd.append('file', f));
   try {
     const res = await fetch('/convert', {method:'POST', body:fd});
     clearInterval(timer); bar.style.width = '100%';
@@ -2606,40 +4714,153 @@ def convert():
     if 'file' not in request.files:
         return jsonify({'error': 'ファイルが見つかりません'}), 400
     
-    f = request.files['file']
-    if not f.filename:
+    # 複数ファイル・ZIP も可（口座別・月別のCSVをまとめて1冊に）
+    uploads = [(f.filename, f.stream) for f in request.files.getlist('file') if f.filename]
+    if not uploads:
         return jsonify({'error': 'ファイルが選択されていません'}), 400
     
     try:
-        file_bytes = f.read()
-        records = parse_bank_csv(file_bytes)
+        rules = get_rule_index()  # このリクエスト中は同じ辞書を使う
+        stats = RuleStats() if request.form.get('rule_stats') in ('1', 'true', 'on') else None
+        incremental = request.form.get('incremental') in ('1', 'true', 'on')
+        values_only = request.form.get('values_only') in ('1', 'true', 'on')  # 残高・合計を数式でなく数値で
+        
+        # Excel生成エンジン: standard / write_only / stream（省略時は件数で自動選択）
+        engine = request.form.get('engine', '').strip()
+        if engine not in ('', 'auto', 'standard', 'write_only', 'stream'):
+            return jsonify({'error': 'engine は standard / write_only / stream / auto のいずれかです'}), 400
+        
+        # 分割出力: year（年度別）/ month（月別）のブックをZIPにまとめる
+        split = request.form.get('split', '').strip()
+        if split not in ('', 'year', 'month'):
+            return jsonify({'error': 'split は year / month のいずれかです'}), 400
+        try:
+            fiscal_start = int(request.form.get('fiscal_start') or FISCAL_YEAR_START)
+        except ValueError:
+            fiscal_start = 0
+        if not 1 <= fiscal_start <= 12:
+            return jsonify({'error': 'fiscal_start は 1〜12 の月で指定してください'}), 400
+        if split:
+            mimetype = 'application/zip'
+        else:
+            mimetype = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        
+        # 同じ内容・辞書・オプションの変換結果があれば、解析も生成もせずにそのファイルを返す
+        # （差分取込は取込済みの状態で結果が変わるのでキャッシュしない）
+        cache_key = None
+        if EXCEL_CACHE.enabled and not incremental:
+            CORRECTIONS.refresh()
+            cache_key = WorkbookCache.key(uploads, rules.version, CORRECTIONS.revision(),
+                                          engine or 'auto', stats is not None, values_only,
+                                          split, fiscal_start if split == 'year' else '')
+            hit = EXCEL_CACHE.get(cache_key)
+            if hit is not None:
+                cached, headers = hit
+                response = send_file(cached, mimetype=mimetype, etag=cache_key, conditional=True)
+                response.headers.update(headers)
+                response.headers['X-Cache'] = 'hit'
+                return response
+        
+        files = expand_uploads(uploads)
+        if not files:
+            return jsonify({'error': 'ZIPの中にCSVファイルが見つかりません'}), 400
+        
+        records, infos = parse_uploads(files, rules, stats, incremental)
+        table = TransactionTable(records)
+        timeouts = sum(info['similar_timeouts'] for info in infos)
+        if timeouts and cache_key:
+            # 類似推定を時間切れで打ち切った行は次回と結果が変わりうるので、この結果はキャッシュしない
+            print(f"⏱️ 類似推定の時間切れ {timeouts} 件のため変換結果をキャッシュしません")
+            cache_key = None
         
         if not records:
+            if incremental and any(info['skipped_rows'] for info in infos):
+                return jsonify({'error': '新しい明細はありません（すべて取込済みです）'}), 400
             return jsonify({'error': 'データが読み込めませんでした。CSVの形式を確認してください'}), 400
         
-        wb = build_excel(records)
+        # 分割時は部分ごとの件数で選ぶ
+        engine = resolve_engine(engine, None if split else len(records))
+        rule_report = stats.report(rules) if stats else None
         
         # ファイル名生成
         years  = sorted(set(r['year'] for r in records))
         months = sorted(set(r['month'] for r in records))
         year_str = f"{years[0]}" if len(years) == 1 else f"{years[0]}-{years[-1]}"
         filename = f"E-MEITA仕訳Excel_{year_str}年_月別.xlsx"
+        if split:
+            parts = split_records(table.records, split, fiscal_start)
+            filename = f"E-MEITA仕訳Excel_{year_str}年_{'年度別' if split == 'year' else '月別'}.zip"
         
-        # メモリに保存して返す
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
+        affected = sorted({ym for info in infos for ym in info['affected_months']})
         
         encoded_name = urllib.parse.quote(filename)
         
-        return Response(
-            buf.getvalue(),
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            headers={
-                'Content-Disposition': f"attachment; filename*=UTF-8''{encoded_name}",
-                'X-Record-Count': str(len(records)),
-            }
-        )
+        def joined(key):
+            return ','.join(dict.fromkeys(info[key] or '' for info in infos))
+        
+        def error_lines(key):
+            # 複数ファイルのときは「ファイル番号:行番号」
+            if len(infos) == 1:
+                return ','.join(map(str, infos[0][key][:20]))
+            return ','.join(f"{i}:{n}" for i, info in enumerate(infos, 1) for n in info[key])[:400]
+        
+        headers = {
+            'Content-Disposition': f"attachment; filename*=UTF-8''{encoded_name}",
+            'X-Record-Count': str(len(records)),
+            'X-File-Count': str(len(infos)),
+            'X-Excel-Engine': engine,
+            'X-Skipped-Rows': str(sum(info['skipped_rows'] for info in infos)),
+            'X-Affected-Months': ','.join(f"{y}-{m:02d}" for y, m in affected),
+            'X-Rule-Version': urllib.parse.quote(rules.version),
+            'X-Bank-Profile': urllib.parse.quote(joined('profile')),
+            'X-Encoding': joined('encoding'),
+            'X-Decode-Errors': str(sum(info['decode_error_count'] for info in infos)),
+            'X-Decode-Error-Lines': error_lines('decode_errors'),
+            'X-Date-Format': joined('date_format'),
+            'X-Date-Mismatch-Rows': str(sum(info['date_mismatch_count'] for info in infos)),
+            'X-Invalid-Date-Rows': str(sum(info['date_invalid_count'] for info in infos)),
+            'X-Invalid-Date-Lines': error_lines('date_invalid_lines'),
+        }
+        
+        def mark_ingested():
+            # 変換できたので今回の新しい行を取込済みにする
+            if incremental:
+                FINGERPRINTS.add(fp for info in infos for fp in info['new_fingerprints'])
+        
+        if split or engine == 'stream':
+            check_sheet_text(table)  # 返し始めてからは JSON のエラーを返せない
+        
+        if split:
+            # 部分ごとのブックを並列に作り、できた分からZIPに入れて返す
+            headers['X-Split-Parts'] = str(len(parts))
+            def body():
+                yield from split_excel(parts, rules.version, rule_report, engine, values_only)
+                mark_ingested()
+            content = body()
+            if cache_key:
+                content = EXCEL_CACHE.tee(cache_key, content, headers)
+        elif engine == 'stream':
+            # 書いたそばから返す（ブック全体をメモリに溜めない）
+            def body():
+                yield from stream_excel(table, rules.version, rule_stats=rule_report, values_only=values_only)
+                mark_ingested()
+            content = body()
+            if cache_key:
+                content = EXCEL_CACHE.tee(cache_key, content, headers)
+        else:
+            wb = build_excel(table, rules.version, rule_stats=rule_report,
+                             write_only=engine == 'write_only', values_only=values_only)
+            # メモリに保存して返す
+            content = save_workbook_bytes(wb)
+            mark_ingested()
+            if cache_key:
+                EXCEL_CACHE.put(cache_key, content, headers)
+        
+        response = Response(content, mimetype=mimetype, headers=headers)
+        if cache_key:
+            response.set_etag(cache_key)
+            response.headers['X-Cache'] = 'miss'
+        return response
     
     except Exception as e:
         import traceback
@@ -2677,6 +4898,59 @@ def evaluate():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/corrections', methods=['GET', 'POST'])
+def corrections():
+    """
+    手修正の上書き表
+    GET: 一覧 / POST: 一括登録（JSON配列、またはCSV「摘要,科目,補助科目,入出金」を file で送信）
+    """
+    if request.method == 'GET':
+        items = CORRECTIONS.all()
+        return jsonify({'count': len(items), 'corrections': items})
+
+    try:
+        if 'file' in request.files:
+            text = decode_csv_bytes(request.files['file'].read())
+            rows = [{'description': r.get('摘要'), 'subject': r.get('科目'),
+                     'sub_subject': r.get('補助科目'), 'direction': r.get('入出金')}
+                    for r in csv.DictReader(io.StringIO(text))]
+        else:
+            rows = request.get_json(silent=True)
+            if not isinstance(rows, list):
+                return jsonify({'error': '上書きデータが見つかりません'}), 400
+        count = CORRECTIONS.bulk_load(rows)
+        return jsonify({'loaded': count, 'total': len(CORRECTIONS.all())})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+
+@app.route('/rule-stats', methods=['GET', 'DELETE'])
+def rule_stats():
+    """仕訳ルールのヒット集計（プロセス起動後の累計）。DELETEでリセット"""
+    if request.method == 'DELETE':
+        CLASSIFY_STATS.reset()
+        return jsonify({'reset': True})
+
+    report = CLASSIFY_STATS.report(top=request.args.get('top', 100, type=int))
+    report['cache'] = CLASSIFY_CACHE.info()
+    return jsonify(report)
+
+
+@app.route('/fingerprints', methods=['GET', 'DELETE'])
+def fingerprints():
+    """差分取込の取込済み指紋: GET=月別件数 / DELETE=消去（?since=YYYY-MM でその月以降だけ）"""
+    if request.method == 'DELETE':
+        since = request.args.get('since', '').strip()
+        try:
+            since = tuple(int(x) for x in since.split('-')) if since else None
+            if since is not None and (len(since) != 2 or not 1 <= since[1] <= 12):
+                raise ValueError
+        except ValueError:
+            return jsonify({'error': 'since は YYYY-MM 形式で指定してください'}), 400
+        return jsonify({'deleted': FINGERPRINTS.clear(since)})
+    return jsonify(FINGERPRINTS.info())
+
+
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 10000))
     print(f"🏦 銀行明細変換システム起動中... http://localhost:{port}")